@@ -0,0 +1,111 @@
+"""Length-bucketed batching with per-batch padding trimmed to the longest sequence.
+
+Features are padded to `max_seq_length` when they are converted, but most text
+pairs are much shorter. `BucketBatchSampler` groups examples of similar length
+into the same batch and `trim_bert_batch` cuts every batch down to its longest
+real sequence, so the model only computes over (almost) real tokens.
+"""
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler, Subset
+from torch.utils.data.dataloader import default_collate
+
+
+def dataset_lengths(dataset):
+    """Number of real tokens of every example of a BERT dataset."""
+    if hasattr(dataset, "lengths"):
+        return np.asarray(dataset.lengths)
+    if isinstance(dataset, Subset):
+        return dataset_lengths(dataset.dataset)[np.asarray(dataset.indices, dtype=np.int64)]
+    # TensorDataset(input_ids, input_mask, segment_ids, label_ids, preprob)
+    return dataset.tensors[1].sum(dim=1).numpy()
+
+
+class BucketBatchSampler(Sampler):
+    """Yields batches of indices of similar length.
+
+    With `shuffle` the indices are shuffled, cut into buckets of
+    `bucket_size` batches, sorted by length inside each bucket and the
+    resulting batches are shuffled again, so batches are homogeneous in length
+    but still random from epoch to epoch. Without `shuffle` the whole dataset
+    is sorted by length (stable) and `order` holds the iteration order, which
+    `restore_order` uses to put outputs back in dataset order.
+
+    A `sampler` (e.g. the `DistributedSampler` of a rank) draws the shuffled
+    indices instead of a permutation of the whole dataset, so only its share is
+    bucketed; `set_epoch` is passed on to it.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100, generator=None, sampler=None):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.generator = generator
+        self.sampler = sampler
+        self.order = None if shuffle else np.argsort(-self.lengths, kind="stable")
+
+    def set_epoch(self, epoch):
+        if self.sampler is not None:
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        if not self.shuffle:
+            for start in range(0, len(self.order), self.batch_size):
+                yield self.order[start:start + self.batch_size].tolist()
+            return
+
+        if self.sampler is not None:
+            perm = np.fromiter(iter(self.sampler), dtype=np.int64)
+        else:
+            perm = torch.randperm(len(self.lengths), generator=self.generator).numpy()
+        window = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(perm), window):
+            bucket = perm[start:start + window]
+            bucket = bucket[np.argsort(-self.lengths[bucket], kind="stable")]
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        for i in torch.randperm(len(batches), generator=self.generator).tolist():
+            yield batches[i].tolist()
+
+    def __len__(self):
+        num_indices = len(self.sampler) if self.sampler is not None else len(self.lengths)
+        return (num_indices + self.batch_size - 1) // self.batch_size
+
+
+def restore_order(values, order):
+    """Puts `values`, produced in `order`, back in dataset order."""
+    if order is None:
+        return values
+    restored = np.empty_like(values)
+    restored[order] = values
+    return restored
+
+
+def trim_bert_batch(items):
+    """Collates BERT items and trims ids, mask and segments to the longest sequence in the batch."""
+    input_ids, input_mask, segment_ids, label_ids, preprob = default_collate(items)
+    max_len = int(input_mask.sum(dim=1).max())
+    return (input_ids[:, :max_len], input_mask[:, :max_len], segment_ids[:, :max_len],
+            label_ids, preprob)
+
+
+class PaddingStats(object):
+    """Padding efficiency: real tokens / computed (real + padding) tokens."""
+
+    def __init__(self):
+        self.real_tokens = 0
+        self.computed_tokens = 0
+
+    def update(self, input_mask):
+        # kept as a tensor on the mask's device, so updating never waits for the device
+        self.real_tokens = input_mask.sum() + self.real_tokens
+        self.computed_tokens += input_mask.numel()
+
+    def efficiency(self):
+        return int(self.real_tokens) / self.computed_tokens if self.computed_tokens > 0 else 0.0
+
+    def reset(self):
+        self.real_tokens = 0
+        self.computed_tokens = 0
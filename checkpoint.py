@@ -0,0 +1,119 @@
+"""Checkpoints written from a background thread.
+
+`CheckpointWriter.save` copies a state_dict to host memory on the calling
+thread (so training can go on changing the weights) and a background thread
+writes it to a temporary file that is renamed into place, so a crash never
+leaves a truncated checkpoint behind. Of the checkpoints written by the
+writer, only the `keep_best` best by score and the latest one are kept.
+`save_state` writes any other state (see `--resume`) the same way, and
+`rng_state` / `set_rng_state` capture and restore the random generators.
+"""
+
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def snapshot(state, fp16=False):
+    """Host memory copy of the tensors (and arrays) in `state`, a nest of dicts, lists and tuples.
+
+    Floating point tensors are stored in fp16 if `fp16`.
+    """
+    if torch.is_tensor(state):
+        tensor = state.detach()
+        if fp16 and tensor.is_floating_point():
+            tensor = tensor.half()
+        return tensor.to("cpu", copy=True)
+    if isinstance(state, np.ndarray):
+        return state.copy()
+    if isinstance(state, dict):
+        return {key: snapshot(value, fp16) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value, fp16) for value in state)
+    return state
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints to `output_dir` in a background thread and prunes all but the best `keep_best`.
+
+    `keep_best=0` keeps every checkpoint. Scores are "higher is better"; on
+    equal scores the earlier checkpoint ranks first. `checkpoints` lists the
+    `(score, path)` of the kept checkpoints in the order they were saved.
+    """
+
+    def __init__(self, output_dir, keep_best=0, fp16=False):
+        self.output_dir = output_dir
+        self.keep_best = keep_best
+        self.fp16 = fp16
+        self.checkpoints = []
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state_dict, file_name, score):
+        path = os.path.join(self.output_dir, file_name)
+        self.checkpoints.append((score, path))
+        self.queue.put((snapshot(state_dict, self.fp16), path, self._prune()))
+        return path
+
+    def save_state(self, state, file_name):
+        """Writes `state` in full precision, outside of the best-k retention."""
+        path = os.path.join(self.output_dir, file_name)
+        self.queue.put((snapshot(state), path, []))
+        return path
+
+    def _prune(self):
+        """Drops all but the best `keep_best` and the latest checkpoint; returns the paths to delete."""
+        if self.keep_best <= 0:
+            return []
+        ranked = sorted(range(len(self.checkpoints)), key=lambda i: (-self.checkpoints[i][0], i))
+        keep = set(ranked[:self.keep_best]) | {len(self.checkpoints) - 1}
+        removed = [path for i, (_, path) in enumerate(self.checkpoints) if i not in keep]
+        self.checkpoints = [c for i, c in enumerate(self.checkpoints) if i in keep]
+        return removed
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            state, path, removed = item
+            try:
+                tmp_path = path + ".tmp"
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+                for old_path in removed:
+                    if os.path.exists(old_path):
+                        os.remove(old_path)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        """Waits until every queued checkpoint is written; raises the first error of the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def rng_state():
+    """States of the Python, NumPy and torch (CPU and CUDA) random number generators."""
+    return {"python": random.getstate(),
+            "numpy": np.random.get_state(),
+            "torch": torch.get_rng_state(),
+            "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
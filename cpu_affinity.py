@@ -0,0 +1,67 @@
+"""Pinning CPU data-parallel processes to disjoint groups of cores.
+
+With one training process per NUMA node (or per group of cores) every process
+should compute with the cores, and the memory, of its own group only: its
+intra-op threads are pinned with `sched_setaffinity` and their number is set
+to the size of the group, so the processes do not oversubscribe the machine.
+"""
+
+import glob
+import os
+import re
+
+import torch
+
+
+def _parse_cpulist(text):
+    """CPU ids of a Linux cpulist such as "0-3,8-11"."""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_node_cpus():
+    """CPU ids of every NUMA node (empty if the topology is not exposed)."""
+    nodes = []
+    paths = glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")
+    for path in sorted(paths, key=lambda p: int(re.search(r"node(\d+)", p).group(1))):
+        with open(path) as f:
+            cpus = _parse_cpulist(f.read())
+        if cpus:
+            nodes.append(cpus)
+    return nodes
+
+
+def core_groups(num_groups):
+    """Splits the CPUs this process may run on into `num_groups` disjoint groups.
+
+    With one group per NUMA node the groups are the nodes, otherwise
+    contiguous ranges of CPU ids of (almost) equal size.
+    """
+    available = sorted(os.sched_getaffinity(0))
+    nodes = [[cpu for cpu in node if cpu in available] for node in numa_node_cpus()]
+    nodes = [node for node in nodes if node]
+    if len(nodes) == num_groups:
+        return nodes
+    if num_groups > len(available):
+        raise ValueError("Cannot split %d CPUs into %d core groups" % (len(available), num_groups))
+    size, extra = divmod(len(available), num_groups)
+    groups, start = [], 0
+    for i in range(num_groups):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(available[start:end])
+        start = end
+    return groups
+
+
+def pin_to_cores(cores):
+    """Restricts this process to `cores` and uses one intra-op thread per core."""
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
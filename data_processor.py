@@ -1,9 +1,11 @@
 import csv
+import hashlib
+import json
 import os
 import sys
+import numpy as np
 import torch
 import torchvision
-import torchvision.transforms as transforms
 
 
 class InputExample(object):
@@ -30,6 +32,9 @@ class InputExample(object):
 class DataProcessor(object):
     """Base class for data converters for sequence classification data sets."""
 
+    # input file names of every split, relative to `data_dir`
+    data_files = {}
+
     def get_train_examples(self, data_dir):
         """Gets a collection of `InputExample`s for the train set."""
         raise NotImplementedError()
@@ -42,17 +47,32 @@ class DataProcessor(object):
         """Gets the list of labels for this data set."""
         raise NotImplementedError()
 
+    def get_data_files(self, data_dir, set_type):
+        """Gets the paths of the input files `set_type` ("train", "dev", "test") is read from."""
+        return [os.path.join(data_dir, name) for name in self.data_files.get(set_type, [])]
+
+    def iter_examples(self, data_dir, set_type):
+        """Lazily yields the `InputExample`s of `set_type`, reading the input file as it goes."""
+        return self._iter_examples(self._iter_tsv(self.get_data_files(data_dir, set_type)[0]), set_type)
+
+    def _iter_examples(self, lines, set_type):
+        """Yields an `InputExample` for every example line of `lines`."""
+        raise NotImplementedError()
+
     @classmethod
     def _read_tsv(cls, input_file, quotechar=None):
         """Reads a tab separated value file."""
+        return list(cls._iter_tsv(input_file, quotechar))
+
+    @classmethod
+    def _iter_tsv(cls, input_file, quotechar=None):
+        """Yields the lines of a tab separated value file one at a time."""
         with open(input_file, "r", encoding="utf-8") as f:
             reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
-            lines = []
             for line in reader:
                 if sys.version_info[0] == 2:
                     line = list(unicode(cell, 'utf-8') for cell in line)
-                lines.append(line)
-            return lines
+                yield line
 
 
 class MrpcProcessor(DataProcessor):
@@ -226,20 +246,22 @@ class StsbProcessor(DataProcessor):
 class QqpProcessor(DataProcessor):
     """Processor for the QQP data set (GLUE version)."""
 
+    data_files = {"train": ["train.tsv"], "dev": ["dev.tsv"], "test": ["test.tsv"]}
+
     def get_train_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+            self._read_tsv(self.get_data_files(data_dir, "train")[0]), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+            self._read_tsv(self.get_data_files(data_dir, "dev")[0]), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+            self._read_tsv(self.get_data_files(data_dir, "test")[0]), "test")
 
     def get_labels(self):
         """See base class."""
@@ -247,7 +269,10 @@ class QqpProcessor(DataProcessor):
 
     def _create_examples(self, lines, set_type):
         """Creates examples for the training and dev sets."""
-        examples = []
+        return list(self._iter_examples(lines, set_type))
+
+    def _iter_examples(self, lines, set_type):
+        """Yields examples for the training and dev sets."""
         for (i, line) in enumerate(lines):
             if i == 0:
                 continue
@@ -258,29 +283,29 @@ class QqpProcessor(DataProcessor):
                 label = line[5]
             except IndexError:
                 continue
-            examples.append(
-                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-        return examples
+            yield InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label)
 
 
 class QnliProcessor(DataProcessor):
     """Processor for the QNLI data set (GLUE version)."""
 
+    data_files = {"train": ["train.tsv"], "dev": ["dev.tsv"], "test": ["test.tsv"]}
+
     def get_train_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+            self._read_tsv(self.get_data_files(data_dir, "train")[0]), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "dev.tsv")),
+            self._read_tsv(self.get_data_files(data_dir, "dev")[0]),
             "dev_matched")
 
     def get_test_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+            self._read_tsv(self.get_data_files(data_dir, "test")[0]), "test")
 
     def get_labels(self):
         """See base class."""
@@ -288,7 +313,10 @@ class QnliProcessor(DataProcessor):
 
     def _create_examples(self, lines, set_type):
         """Creates examples for the training and dev sets."""
-        examples = []
+        return list(self._iter_examples(lines, set_type))
+
+    def _iter_examples(self, lines, set_type):
+        """Yields examples for the training and dev sets."""
         for (i, line) in enumerate(lines):
             if i == 0:
                 continue
@@ -296,9 +324,7 @@ class QnliProcessor(DataProcessor):
             text_a = line[1]
             text_b = line[2]
             label = line[-1]
-            examples.append(
-                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-        return examples
+            yield InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label)
 
 
 class RteProcessor(DataProcessor):
@@ -368,20 +394,22 @@ class WnliProcessor(DataProcessor):
 class WikiQAProcessor(DataProcessor):
     """Processor for the wiki QA data set."""
 
+    data_files = {"train": ["WikiQA-train.tsv"], "dev": ["WikiQA-dev.tsv"], "test": ["WikiQA-test.tsv"]}
+
     def get_train_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "WikiQA-train.tsv")), "train")
+            self._read_tsv(self.get_data_files(data_dir, "train")[0]), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "WikiQA-dev.tsv")), "dev")
+            self._read_tsv(self.get_data_files(data_dir, "dev")[0]), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "WikiQA-test.tsv")), "test")
+            self._read_tsv(self.get_data_files(data_dir, "test")[0]), "test")
 
     def get_labels(self):
         """See base class."""
@@ -389,7 +417,10 @@ class WikiQAProcessor(DataProcessor):
 
     def _create_examples(self, lines, set_type):
         """Creates examples for the training and dev sets."""
-        examples = []
+        return list(self._iter_examples(lines, set_type))
+
+    def _iter_examples(self, lines, set_type):
+        """Yields examples for the training and dev sets."""
         for (i, line) in enumerate(lines):
             if i == 0:
                 continue
@@ -400,27 +431,28 @@ class WikiQAProcessor(DataProcessor):
             # sent_id = line[4]
             text_b = line[5]  # sentence
             label = line[6]  # label
-            examples.append(InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-        return examples
+            yield InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label)
 
 
 class SemevalProcessor(DataProcessor):
     """Processor for the wiki QA data set."""
 
+    data_files = {"train": ["train.tsv"], "dev": ["dev.tsv"], "test": ["test.tsv"]}
+
     def get_train_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+            self._read_tsv(self.get_data_files(data_dir, "train")[0]), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+            self._read_tsv(self.get_data_files(data_dir, "dev")[0]), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+            self._read_tsv(self.get_data_files(data_dir, "test")[0]), "test")
 
     def get_labels(self):
         """See base class."""
@@ -428,7 +460,10 @@ class SemevalProcessor(DataProcessor):
 
     def _create_examples(self, lines, set_type):
         """Creates examples for the training and dev sets."""
-        examples = []
+        return list(self._iter_examples(lines, set_type))
+
+    def _iter_examples(self, lines, set_type):
+        """Yields examples for the training and dev sets."""
         for (i, line) in enumerate(lines):
             if i == 0:
                 continue
@@ -438,28 +473,29 @@ class SemevalProcessor(DataProcessor):
             label = line[3]  # label
             if label == "PotentiallyUseful":
                 label = "Bad"
-            examples.append(InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-        return examples
+            yield InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label)
 
 
 class QuacProcessor(DataProcessor):
     """Processor for the QUAC data set (GLUE version)."""
 
+    data_files = {"train": ["train.tsv"], "dev": ["dev.tsv"], "test": ["test.tsv"]}
+
     def get_train_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+            self._read_tsv(self.get_data_files(data_dir, "train")[0]), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "dev.tsv")),
+            self._read_tsv(self.get_data_files(data_dir, "dev")[0]),
             "dev_matched")
 
     def get_test_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+            self._read_tsv(self.get_data_files(data_dir, "test")[0]), "test")
 
     def get_labels(self):
         """See base class."""
@@ -467,7 +503,10 @@ class QuacProcessor(DataProcessor):
 
     def _create_examples(self, lines, set_type):
         """Creates examples for the training and dev sets."""
-        examples = []
+        return list(self._iter_examples(lines, set_type))
+
+    def _iter_examples(self, lines, set_type):
+        """Yields examples for the training and dev sets."""
         for (i, line) in enumerate(lines):
             if i == 0:
                 continue
@@ -475,69 +514,75 @@ class QuacProcessor(DataProcessor):
             text_a = line[1]
             text_b = line[2]
             label = line[-1]
-            examples.append(
-                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-        return examples
+            yield InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label)
 
 
 class DSTCProcessor(DataProcessor):
     """Processor for the DSTC data set."""
 
+    data_files = {
+        "train": ["dstc8_train_eo_src.txt", "dstc8_train_eo_tgt.txt"],
+        "dev": ["dstc8_dev_eo_src.txt", "dstc8_dev_eo_tgt.txt"],
+        "test": ["test.tsv"],
+    }
+
     def get_train_examples(self, data_dir):
         """See base class."""
-        return self._create_examples("train", os.path.join(data_dir, "dstc8_train_eo_src.txt"),
-                                     os.path.join(data_dir, "dstc8_train_eo_tgt.txt"))
+        return self._create_examples("train", *self.get_data_files(data_dir, "train"))
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples("dev", os.path.join(data_dir, "dstc8_dev_eo_src.txt"),
-                                     os.path.join(data_dir, "dstc8_dev_eo_tgt.txt"))
+        return self._create_examples("dev", *self.get_data_files(data_dir, "dev"))
 
     def get_test_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+            self._read_tsv(self.get_data_files(data_dir, "test")[0]), "test")
 
     def get_labels(self):
         """See base class."""
         return ["0", "1"]
 
+    def iter_examples(self, data_dir, set_type):
+        """See base class."""
+        return self._iter_examples(set_type, *self.get_data_files(data_dir, set_type))
+
     def _create_examples(self, set_type, src, tgt):
         """Creates examples for the training and dev sets."""
-        examples = []
-        fs = open(src, "r", encoding="utf-8")
-        ft = open(tgt, "r", encoding="utf-8")
-
-        for s, t in zip(fs.readlines(), ft.readlines()):
-            dialog_id, ans_idx, candi_idx, candi_sent = t.split("__DELIM__")
-            guid = "%s-%s-%s" % (set_type, dialog_id, candi_idx)
-            text_a = s
-            text_b = candi_sent
-            label = "1" if ans_idx == candi_idx else "0"
-            examples.append(
-                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
+        return list(self._iter_examples(set_type, src, tgt))
 
-        return examples
+    def _iter_examples(self, set_type, src, tgt):
+        """Yields examples for the training and dev sets, reading the src/tgt files line by line."""
+        with open(src, "r", encoding="utf-8") as fs, open(tgt, "r", encoding="utf-8") as ft:
+            for s, t in zip(fs, ft):
+                dialog_id, ans_idx, candi_idx, candi_sent = t.split("__DELIM__")
+                guid = "%s-%s-%s" % (set_type, dialog_id, candi_idx)
+                text_a = s
+                text_b = candi_sent
+                label = "1" if ans_idx == candi_idx else "0"
+                yield InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label)
 
 
 class UbuntuProcessor(DataProcessor):
     """Processor for the Ubuntu data set (DSTC7 subtask 1)."""
 
+    data_files = {"train": ["ubuntu_train.tsv"], "dev": ["ubuntu_dev.tsv"], "test": ["ubuntu_test.tsv"]}
+
     def get_train_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "ubuntu_train.tsv")), "train")
+            self._read_tsv(self.get_data_files(data_dir, "train")[0]), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "ubuntu_dev.tsv")),
+            self._read_tsv(self.get_data_files(data_dir, "dev")[0]),
             "dev_matched")
 
     def get_test_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "ubuntu_test.tsv")), "test")
+            self._read_tsv(self.get_data_files(data_dir, "test")[0]), "test")
 
     def get_labels(self):
         """See base class."""
@@ -545,34 +590,37 @@ class UbuntuProcessor(DataProcessor):
 
     def _create_examples(self, lines, set_type):
         """Creates examples for the training and dev sets."""
-        examples = []
+        return list(self._iter_examples(lines, set_type))
+
+    def _iter_examples(self, lines, set_type):
+        """Yields examples for the training and dev sets."""
         for (i, line) in enumerate(lines):
             guid = line[0]
             text_a = line[1]
             text_b = line[2]
             label = line[-1]
-            examples.append(
-                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-        return examples
+            yield InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label)
 
 
 class SelQAProcessor(DataProcessor):
     """Processor for the selQA dataset."""
 
+    data_files = {"train": ["selqa-at-train.tsv"], "dev": ["selqa-at-dev.tsv"], "test": ["selqa-at-test.tsv"]}
+
     def get_train_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "selqa-at-train.tsv")))
+            self._read_tsv(self.get_data_files(data_dir, "train")[0]))
 
     def get_dev_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "selqa-at-dev.tsv")))
+            self._read_tsv(self.get_data_files(data_dir, "dev")[0]))
 
     def get_test_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "selqa-at-test.tsv")))
+            self._read_tsv(self.get_data_files(data_dir, "test")[0]))
 
     def get_labels(self):
         """See base class."""
@@ -580,304 +628,262 @@ class SelQAProcessor(DataProcessor):
 
     def _create_examples(self, lines):
         """Creates examples for the training and dev sets."""
-        examples = []
+        return list(self._iter_examples(lines))
+
+    def _iter_examples(self, lines, set_type=None):
+        """Yields examples for the training and dev sets."""
         for (i, line) in enumerate(lines):
             guid = None
             text_a = line[0]
             text_b = line[1]
             label = line[-1]
-            examples.append(
-                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-        return examples
-
+            yield InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label)
+
+
+def normalize_images(images, mean, std):
+    """Turns a uint8 (N, C, H, W) batch into model inputs: `ToTensor()` followed by `Normalize(mean, std)`."""
+    mean = torch.tensor(mean, dtype=torch.float, device=images.device).view(1, -1, 1, 1)
+    std = torch.tensor(std, dtype=torch.float, device=images.device).view(1, -1, 1, 1)
+    return images.float().div_(255).sub_(mean).div_(std)
+
+
+def _split_rows(split_id, source_id, index):
+    return np.stack([np.full(len(index), split_id), np.full(len(index), source_id), index], axis=1)
+
+
+class ImageDataProcessor(DataProcessor):
+    """Base class for the torchvision image data sets.
+
+    The images stay in the raw uint8 arrays of the torchvision data sets
+    ("sources", as (N, C, H, W) views) and `get_*_examples` gather
+    `(images, labels)` of a split as a uint8 array and an int64 array. Batches
+    are turned into normalized float inputs with
+    `normalize_images(batch, processor.mean, processor.std)`.
+
+    Train/dev splits follow an imbalance recipe: `major_class` keeps all of
+    its training images, every other class keeps `minor_train_size` of them
+    (or `n_major / imbalance_ratio` with `imbalance_ratio`), and the first
+    `dev_size[source]` images of every class and source go to dev (after a
+    per-class shuffle with `seed`). Nothing is loaded in `__init__`. The
+    labels of every source and the (split, source, index) rows of every
+    recipe are saved as small .npy manifests under `<root>/manifests`, so a
+    split is rebuilt from them without loading the torchvision data set again;
+    images are only read when a split is actually gathered.
+    """
+
+    mean = (0.5, 0.5, 0.5)
+    std = (0.5, 0.5, 0.5)
+
+    name = None  # manifest file prefix, shared by processors of the same data set
+    display_name = None
+    root = './data'
+    source_names = ("train", "test")
+    test_source = "test"
+
+    # default imbalance recipe
+    classes = tuple(range(10))
+    major_class = 0
+    dev_size = {"train": 500}
+    minor_train_size = None
+
+    def __init__(self, imbalance_ratio=None, seed=None):
+        self.imbalance_ratio = imbalance_ratio
+        self.seed = seed
+        self._sources = {}
+        self._labels = {}
+        self._splits = None
+
+    def _load_source(self, source):
+        """(uint8 images (N, C, H, W), labels) of the torchvision source `source`."""
+        raise NotImplementedError()
 
-class CIFAR10BinaryProcessor(DataProcessor):
-
-    def __init__(self):
-        self.transform = transforms.Compose(
-            [transforms.ToTensor(),
-             transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
-        self.trainset = torchvision.datasets.CIFAR10(root='./data', train=True,
-                                                     download=True, transform=self.transform)
-        self.testset = torchvision.datasets.CIFAR10(root='./data', train=False,
-                                                   download=True, transform=self.transform)
-        self.train_features = None
-        self.train_labels = None
-        self.dev_features = None
-        self.dev_labels = None
-        self.divide_dataset()
-
-    def divide_dataset(self):
-        negatives = []
-        n_labels = []
-        positives = []
-        p_labels = []
-        for e in self.trainset:
-            vector, label = e
-            if label == 3:
-                negatives.append(vector.tolist())
-                n_labels.append(0)
-            elif label == 5:
-                positives.append(vector.tolist())
-                p_labels.append(1)
-        dev_size = 500
-        # TODO change size (1:5 or 1:10)
-        self.train_features = negatives[dev_size:] + positives[dev_size:dev_size+900]
-        self.train_labels = n_labels[dev_size:] + p_labels[dev_size:dev_size+900]
-        self.dev_features = negatives[:dev_size] + positives[:dev_size]
-        self.dev_labels = n_labels[:dev_size] + p_labels[:dev_size]
+    def recipe(self):
+        return {"dataset": self.name, "classes": list(self.classes), "major_class": self.major_class,
+                "dev_size": self.dev_size, "minor_train_size": self.minor_train_size,
+                "imbalance_ratio": self.imbalance_ratio, "seed": self.seed}
+
+    def recipe_key(self):
+        blob = json.dumps(self.recipe(), sort_keys=True)
+        return hashlib.sha1(blob.encode("utf-8")).hexdigest()[:12]
+
+    def _manifest_path(self, name):
+        return os.path.join(self.root, "manifests", "%s-%s.npy" % (self.name, name))
+
+    def _save_manifest(self, name, array):
+        path = self._manifest_path(name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "%s.tmp-%d.npy" % (path[:-len(".npy")], os.getpid())
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+
+    def _source(self, source):
+        if source not in self._sources:
+            images, labels = self._load_source(source)
+            self._sources[source] = images
+            self._labels[source] = np.asarray(labels, dtype=np.int64)
+        return self._sources[source]
+
+    def _source_labels(self, source):
+        if source not in self._labels:
+            path = self._manifest_path("%s-labels" % source)
+            if os.path.exists(path):
+                self._labels[source] = np.load(path)
+            else:
+                self._source(source)
+                self._save_manifest("%s-labels" % source, self._labels[source])
+        return self._labels[source]
+
+    def _class_indices(self, source, c, rng):
+        index = np.flatnonzero(self._source_labels(source) == c)
+        return index if rng is None else rng.permutation(index)
+
+    def _build_splits(self):
+        """(split, source, index) rows of the recipe; split 0 is train and 1 is dev."""
+        rng = None if self.seed is None else np.random.RandomState(self.seed)
+        train_sources = list(self.dev_size)
+        class_index = {c: [self._class_indices(source, c, rng) for source in train_sources] for c in self.classes}
+
+        minor_train_size = self.minor_train_size
+        if self.imbalance_ratio is not None:
+            n_major = sum(len(index[self.dev_size[source]:])
+                          for source, index in zip(train_sources, class_index[self.major_class]))
+            minor_train_size = max(1, int(round(n_major / self.imbalance_ratio)))
+
+        rows = []
+        for c in self.classes:
+            train_rows, dev_rows = [], []
+            for source, index in zip(train_sources, class_index[c]):
+                source_id = self.source_names.index(source)
+                dev_size = self.dev_size[source]
+                train_rows.append(_split_rows(0, source_id, index[dev_size:]))
+                dev_rows.append(_split_rows(1, source_id, index[:dev_size]))
+            train_rows, dev_rows = np.concatenate(train_rows), np.concatenate(dev_rows)
+            if c != self.major_class and minor_train_size is not None:
+                train_rows = train_rows[:minor_train_size]
+            print("[%s] class %d data: train %d / dev %d" % (self.display_name, c, len(train_rows), len(dev_rows)))
+            rows += [train_rows, dev_rows]
+        return np.concatenate(rows)
+
+    def _split(self, split):
+        """(source, index) rows of `split`."""
+        if split == "test":
+            source_id = self.source_names.index(self.test_source)
+            index = np.flatnonzero(np.isin(self._source_labels(self.test_source), self.classes))
+            return np.stack([np.full(len(index), source_id), index], axis=1)
+        if self._splits is None:
+            name = "recipe-%s" % self.recipe_key()
+            path = self._manifest_path(name)
+            if os.path.exists(path):
+                self._splits = np.load(path)
+            else:
+                self._splits = self._build_splits()
+                self._save_manifest(name, self._splits)
+                with open(path[:-len(".npy")] + ".json", "w") as fh:
+                    json.dump(self.recipe(), fh, indent=2, sort_keys=True)
+        rows = self._splits[self._splits[:, 0] == {"train": 0, "dev": 1}[split]]
+        return rows[:, 1:]
+
+    def _gather(self, rows):
+        """`(images, labels)` of the (source, index) `rows`, labels numbered by their position in `classes`."""
+        images = None
+        labels = np.empty(len(rows), dtype=np.int64)
+        label_map = np.full(max(self.classes) + 1, -1, dtype=np.int64)
+        label_map[list(self.classes)] = np.arange(len(self.classes))
+        for source_id, source in enumerate(self.source_names):
+            mask = rows[:, 0] == source_id
+            if not mask.any():
+                continue
+            source_images = self._source(source)
+            if images is None:
+                images = np.empty((len(rows),) + source_images.shape[1:], dtype=np.uint8)
+            images[mask] = source_images[rows[mask, 1]]
+            labels[mask] = label_map[self._labels[source][rows[mask, 1]]]
+        if images is None:
+            images = np.empty((0,) + self._source(self.source_names[0]).shape[1:], dtype=np.uint8)
+        return images, labels
+
+    def _examples(self, split):
+        rows = self._split(split)
+        print("[%s] (%s) filtered data: %d" % (self.display_name, split, len(rows)))
+        return self._gather(rows)
 
     def get_train_examples(self, data_dir):
-        print("[CIFAR-10 (Binary)] (train) filtered data: %d" % len(self.train_features))
-        return self.train_features, self.train_labels
+        return self._examples("train")
 
     def get_dev_examples(self, data_dir):
-        print("[CIFAR-10 (Binary)] (dev) filtered data: %d" % len(self.dev_features))
-        return self.dev_features, self.dev_labels
+        return self._examples("dev")
 
     def get_test_examples(self, data_dir):
-        # test data
-        features, labels = [], []
-        for e in self.testset:
-            vector, label = e
-            if label == 3:
-                features.append(vector.tolist())
-                labels.append(0)
-            elif label == 5:
-                features.append(vector.tolist())
-                labels.append(1)
-        print("[CIFAR-10 (Binary)] (test) filtered data: %d" % len(features))
-        return features, labels
+        return self._examples("test")
 
     def get_labels(self):
-        return ["0", "1"]  # cat=3, dog=5
+        return [i for i in range(len(self.classes))]
 
 
-class CIFAR10Processor(DataProcessor):
-
-    def __init__(self):
-        self.transform = transforms.Compose(
-            [transforms.ToTensor(),
-             transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
-        self.trainset = torchvision.datasets.CIFAR10(root='./data', train=True,
-                                                     download=True, transform=self.transform)
-        self.testset = torchvision.datasets.CIFAR10(root='./data', train=False,
-                                                   download=True, transform=self.transform)
-        self.train_features = []
-        self.train_labels = []
-        self.dev_features = []
-        self.dev_labels = []
-        self.adjust_dataset()
-
-    def adjust_dataset(self):
-        n_class = 10
-        dataset, labels = [[] for _ in range(n_class)], [[] for _ in range(n_class)]
-        for e in self.trainset:
-            vector, label = e
-            _class = int(label)
-            # if _class in [0, 1, 2, 3]:
-            dataset[_class].append(vector.tolist())
-            labels[_class].append(_class)
-        dev_size = 500
-        for i in range(n_class):
-            if i == 0:  # set major class
-                self.train_features += dataset[i][dev_size:]
-                self.train_labels += labels[i][dev_size:]
-                self.dev_features += dataset[i][:dev_size]
-                self.dev_labels += labels[i][:dev_size]
-            else:
-                # self.train_features += dataset[i][dev_size:dev_size+900]
-                # self.train_labels += labels[i][dev_size:dev_size+900]
-                self.train_features += dataset[i][dev_size:dev_size + 450]
-                self.train_labels += labels[i][dev_size:dev_size + 450]
-                # self.train_features += dataset[i][dev_size:]
-                # self.train_labels += labels[i][dev_size:]
-                self.dev_features += dataset[i][:dev_size]
-                self.dev_labels += labels[i][:dev_size]
-            print("[CIFAR-10] dev class %d data: %d" % (i, len(dataset[i][:dev_size:])))
-
-        assert len(self.dev_features) == 5000
-        assert len(self.train_features) == 8550
-        # assert len(self.train_features) == 12600
+class CIFAR10BinaryProcessor(ImageDataProcessor):
 
-    def get_train_examples(self, data_dir):
-        print("[CIFAR-10] (train) filtered data: %d" % len(self.train_features))
-        return self.train_features, self.train_labels
+    name = "cifar10"
+    display_name = "CIFAR-10 (Binary)"
+    classes = (3, 5)  # cat=3 (label 0), dog=5 (label 1)
+    major_class = 3
+    dev_size = {"train": 500}
+    minor_train_size = 900
 
-    def get_dev_examples(self, data_dir):
-        print("[CIFAR-10] (dev) filtered data: %d" % len(self.dev_features))
-        return self.dev_features, self.dev_labels
-
-    def get_test_examples(self, data_dir):
-        # test data
-        features, labels = [], []
-        for e in self.testset:
-            vector, label = e
-            _class = int(label)
-            features.append(vector.tolist())
-            labels.append(_class)
-        print("[CIFAR-10] (test) filtered data: %d" % len(features))
-        return features, labels
+    def _load_source(self, source):
+        dataset = torchvision.datasets.CIFAR10(root=self.root, train=(source == "train"), download=True)
+        # (N, H, W, C) -> (N, C, H, W) view
+        return dataset.data.transpose(0, 3, 1, 2), dataset.targets
 
     def get_labels(self):
-        return [i for i in range(10)]
-        # return [0, 1]
+        return ["0", "1"]  # cat=3, dog=5
 
-    def get_class_name(self):
-        return ["airplane", "automobile", "bird", "cat", "deer", "dog",
-                "frog", "horse", "ship", "truck"]
 
+class CIFAR10Processor(ImageDataProcessor):
 
-class MNISTProcessor(DataProcessor):
-
-    def __init__(self):
-        self.transform = transforms.ToTensor()
-        self.trainset = torchvision.datasets.MNIST(root='./data', train=True,
-                                                     download=True, transform=self.transform)
-        self.testset = torchvision.datasets.MNIST(root='./data', train=False,
-                                                    download=True, transform=self.transform)
-        self.train_features = []
-        self.train_labels = []
-        self.dev_features = []
-        self.dev_labels = []
-        self.adjust_dataset()
-
-    def adjust_dataset(self):
-        n_class = 10
-        dataset, labels = [[] for _ in range(n_class)], [[] for _ in range(n_class)]
-        for e in self.trainset:
-            vector, label = e
-            _class = int(label)
-            # if _class in [0, 1, 2, 3]:
-            dataset[_class].append(vector.tolist())
-            labels[_class].append(_class)
-        dev_size = 600
-        for i in range(n_class):
-            if i == 0:  # set major class
-                self.train_features += dataset[i][dev_size:]
-                self.train_labels += labels[i][dev_size:]
-                self.dev_features += dataset[i][:dev_size]
-                self.dev_labels += labels[i][:dev_size]
-                print("[MNIST] major class 0 data: %d" % len(dataset[i][dev_size:]))
-            else:
-                self.train_features += dataset[i][dev_size:dev_size+540]
-                self.train_labels += labels[i][dev_size:dev_size+540]
-                # self.train_features += dataset[i][dev_size:dev_size + 1080]
-                # self.train_labels += labels[i][dev_size:dev_size + 1080]
-                # self.train_features += dataset[i][dev_size:]
-                # self.train_labels += labels[i][dev_size:]
-                self.dev_features += dataset[i][:dev_size]
-                self.dev_labels += labels[i][:dev_size]
-            print("[MNIST] dev class %d data: %d" % (i, len(dataset[i][:dev_size:])))
-
-        assert len(self.dev_features) == 6000
+    name = "cifar10"
+    display_name = "CIFAR-10"
+    dev_size = {"train": 500}
+    minor_train_size = 450  # 900 for 1:5
 
-    def get_train_examples(self, data_dir):
-        print("[MNIST] (train) filtered data: %d" % len(self.train_features))
-        return self.train_features, self.train_labels
+    def _load_source(self, source):
+        dataset = torchvision.datasets.CIFAR10(root=self.root, train=(source == "train"), download=True)
+        # (N, H, W, C) -> (N, C, H, W) view
+        return dataset.data.transpose(0, 3, 1, 2), dataset.targets
 
-    def get_dev_examples(self, data_dir):
-        print("[MNIST] (dev) filtered data: %d" % len(self.dev_features))
-        return self.dev_features, self.dev_labels
+    def get_class_name(self):
+        return ["airplane", "automobile", "bird", "cat", "deer", "dog",
+                "frog", "horse", "ship", "truck"]
 
-    def get_test_examples(self, data_dir):
-        # test data
-        features, labels = [], []
-        for e in self.testset:
-            vector, label = e
-            _class = int(label)
-            features.append(vector.tolist())
-            labels.append(_class)
-        print("[MNIST] (test) filtered data: %d" % len(features))
-        return features, labels
 
-    def get_labels(self):
-        return [i for i in range(10)]
-
-
-class SVHNProcessor(DataProcessor):
-
-    def __init__(self):
-        self.transform = transforms.ToTensor()
-        self.transform = transforms.Compose([transforms.ToTensor(),
-                                             transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
-        self.trainset = torchvision.datasets.SVHN(root='./data/SVHN/', split='train',
-                                                     download=True, transform=self.transform)
-        self.testset = torchvision.datasets.SVHN(root='./data/SVHN/', split='test',
-                                                    download=True, transform=self.transform)
-        self.extraset = torchvision.datasets.SVHN(root='./data/SVHN', split='extra',
-                                                   download=True, transform=self.transform)
-        # self.whole_trainset = torch.utils.data.ConcatDataset([trainset, extraset])
-        self.train_features = []
-        self.train_labels = []
-        self.dev_features = []
-        self.dev_labels = []
-
-    def adjust_dataset(self):
-        n_class = 10
-        train_dataset, train_labels = [[] for _ in range(n_class)], [[] for _ in range(n_class)]
-        extra_dataset, extra_labels = [[] for _ in range(n_class)], [[] for _ in range(n_class)]
-        for e in self.trainset:
-            vector, label = e
-            _class = int(label)
-            # if _class in [0, 1, 2, 3]:
-            train_dataset[_class].append(vector.tolist())
-            train_labels[_class].append(_class)
-
-        for e in self.extraset:
-            vector, label = e
-            _class = int(label)
-            # if _class in [0, 1, 2, 3]:
-            extra_dataset[_class].append(vector.tolist())
-            extra_labels[_class].append(_class)
-
-        train_dev_size = 400
-        extra_dev_size = 200
-        for i in range(n_class):
-            print("[SVHN] major class %d data: %d" % (
-                i, len(train_dataset[i][train_dev_size:]) + len(extra_dataset[i][extra_dev_size:])))
-            if i == 0:  # set major class
-                self.dev_features += train_dataset[i][:train_dev_size]
-                self.dev_features += extra_dataset[i][:extra_dev_size]
-                self.dev_labels += train_labels[i][:train_dev_size]
-                self.dev_labels += extra_labels[i][:extra_dev_size]
-
-                self.train_features += train_dataset[i][train_dev_size:]
-                self.train_features += extra_dataset[i][extra_dev_size:]
-                self.train_labels += train_labels[i][train_dev_size:]
-                self.train_labels += extra_labels[i][extra_dev_size:]
-            else:
-                self.dev_features += train_dataset[i][:train_dev_size]
-                self.dev_features += extra_dataset[i][:extra_dev_size]
-                self.dev_labels += train_labels[i][:train_dev_size]
-                self.dev_labels += extra_labels[i][:extra_dev_size]
+class MNISTProcessor(ImageDataProcessor):
 
-                self.train_features += train_dataset[i][train_dev_size:]
-                self.train_features += extra_dataset[i][extra_dev_size:]
-                self.train_labels += train_labels[i][train_dev_size:]
-                self.train_labels += extra_labels[i][extra_dev_size:]
+    # `ToTensor()` only
+    mean = (0.0,)
+    std = (1.0,)
 
-        assert len(self.dev_features) == 6000
-        assert len(self.train_features) == 598388
+    name = "mnist"
+    display_name = "MNIST"
+    dev_size = {"train": 600}
+    minor_train_size = 540  # 1080 for 1:5
 
-    def get_train_examples(self, data_dir):
-        print("[SVHN] (train) filtered data: %d" % len(self.train_features))
-        return self.train_features, self.train_labels
+    def _load_source(self, source):
+        dataset = torchvision.datasets.MNIST(root=self.root, train=(source == "train"), download=True)
+        # (N, H, W) -> (N, 1, H, W) view
+        return dataset.data.numpy()[:, None], dataset.targets.numpy()
 
-    def get_dev_examples(self, data_dir):
-        print("[SVHN] (dev) filtered data: %d" % len(self.dev_features))
-        return self.dev_features, self.dev_labels
 
-    def get_test_examples(self, data_dir):
-        # test data
-        features, labels = [], []
-        for e in self.testset:
-            vector, label = e
-            _class = int(label)
-            features.append(vector.tolist())
-            labels.append(_class)
-        print("[SVHN] (test) filtered data: %d" % len(features))
-        return features, labels
+class SVHNProcessor(ImageDataProcessor):
 
-    def get_labels(self):
-        return [i for i in range(10)]
\ No newline at end of file
+    name = "svhn"
+    display_name = "SVHN"
+    root = './data/SVHN'
+    source_names = ("train", "extra", "test")
+    # every class keeps all of its training images
+    dev_size = {"train": 400, "extra": 200}
+    minor_train_size = None
+
+    def _load_source(self, source):
+        dataset = torchvision.datasets.SVHN(root=self.root, split=source, download=True)
+        # already (N, C, H, W)
+        return dataset.data, dataset.labels
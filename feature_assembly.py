@@ -0,0 +1,76 @@
+"""Batched assembly of BERT inputs from token ids.
+
+`assemble_bert_inputs` builds the `[CLS] A [SEP] B [SEP]` (or `[CLS] A [SEP]`)
+layouts of a whole chunk of examples at once, writing into preallocated
+`(n, max_seq_length)` arrays. Truncation is computed in closed form by
+`truncate_pair_lengths`, which gives the same lengths as BERT's heuristic of
+popping one token at a time from the longer sequence.
+"""
+
+import itertools
+
+import numpy as np
+
+
+def _ragged(rows):
+    """(values, lengths) of a list of int sequences."""
+    lengths = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+    values = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=int(lengths.sum()))
+    return values, lengths
+
+
+def truncate_pair_lengths(len_a, len_b, max_length):
+    """Lengths of A and B after truncating the pair to `max_length` tokens.
+
+    BERT's heuristic pops from the longer sequence (from B on ties) until the
+    pair fits, so a pair that does not fit ends up with the shorter side
+    kept whole if it fits in its half, and both sides cut to
+    `ceil(max_length / 2)` (A) and `floor(max_length / 2)` (B) otherwise.
+    """
+    half_b = max_length // 2
+    half_a = max_length - half_b
+    new_a = np.minimum(len_a, np.maximum(max_length - len_b, half_a))
+    new_b = np.minimum(len_b, np.maximum(max_length - len_a, half_b))
+    return new_a, new_b
+
+
+def _scatter(out, values, lengths, keep_lengths, first_col):
+    """Writes the first `keep_lengths[i]` of row i's values to `out[i, first_col[i]:]`."""
+    row_start = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    pos = np.arange(len(values)) - row_start
+    keep = pos < np.repeat(keep_lengths, lengths)
+    rows = np.repeat(np.arange(len(lengths)), lengths)[keep]
+    out[rows, np.repeat(first_col, lengths)[keep] + pos[keep]] = values[keep]
+
+
+def assemble_bert_inputs(ids_a, ids_b, is_pair, max_seq_length, cls_id, sep_id):
+    """Builds `(input_ids, input_mask, segment_ids)` arrays of shape `(n, max_seq_length)`.
+
+    `ids_a` / `ids_b` are the token ids of every example (`ids_b[i]` is empty
+    for single sentences) and `is_pair[i]` tells whether example i has a
+    `text_b`, which reserves room for a second [SEP] when truncating.
+    """
+    n = len(ids_a)
+    values_a, len_a = _ragged(ids_a)
+    values_b, len_b = _ragged(ids_b)
+    is_pair = np.asarray(is_pair, dtype=bool)
+
+    # Account for [CLS], [SEP], [SEP] with "- 3" and for [CLS] and [SEP] with "- 2"
+    pair_a, pair_b = truncate_pair_lengths(len_a, len_b, max_seq_length - 3)
+    keep_a = np.where(is_pair, pair_a, np.minimum(len_a, max_seq_length - 2))
+    keep_b = np.where(is_pair, pair_b, 0)
+    has_b = keep_b > 0
+
+    input_ids = np.zeros((n, max_seq_length), dtype=np.int64)
+    rows = np.arange(n)
+    input_ids[:, 0] = cls_id
+    _scatter(input_ids, values_a, len_a, keep_a, np.ones(n, dtype=np.int64))
+    input_ids[rows, keep_a + 1] = sep_id
+    _scatter(input_ids, values_b, len_b, keep_b, keep_a + 2)
+    input_ids[rows[has_b], (keep_a + keep_b + 2)[has_b]] = sep_id
+
+    lengths = keep_a + 2 + np.where(has_b, keep_b + 1, 0)
+    cols = np.arange(max_seq_length)
+    input_mask = (cols < lengths[:, None]).astype(np.int64)
+    segment_ids = ((cols >= (keep_a + 2)[:, None]) & (cols < lengths[:, None])).astype(np.int64)
+    return input_ids, input_mask, segment_ids
@@ -0,0 +1,267 @@
+"""Memory-mapped columnar storage for converted classifier features.
+
+A cache is a directory holding one flat binary file per column and a small
+`header.json` describing them. Token columns only store the real (unpadded)
+tokens of every example plus an offsets array, segment ids are int8 and the
+attention mask is not stored at all; it is rebuilt from the example length.
+Columns are opened with `np.memmap`, so concurrent runs share the page cache
+and opening a cache does not copy anything.
+
+`FeatureCacheStore` keeps such entries side by side under one root, named by a
+hash of everything the converted features depend on (task, tokenizer vocab,
+conversion parameters and input file fingerprints), and evicts the least
+recently used entries once the store grows over its disk budget.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+logger = logging.getLogger(__name__)
+
+HEADER_NAME = "header.json"
+KEY_NAME = "key.json"
+FORMAT_VERSION = 1
+
+
+def _token_dtype(vocab_size):
+    return np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.int32
+
+
+def _ragged(rows, lengths, dtype):
+    """Flattens the first `lengths[i]` items of every row, returns (values, offsets)."""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.empty(offsets[-1], dtype=dtype)
+    for i, (row, n) in enumerate(zip(rows, lengths)):
+        values[offsets[i]:offsets[i + 1]] = row[:n]
+    return values, offsets
+
+
+def _pair_length(ids):
+    """Length of a zero-padded `InputPairFeatures` id list (0 is the RNN padding index)."""
+    for i in range(len(ids) - 1, -1, -1):
+        if ids[i] != 0:
+            return i + 1
+    return 0
+
+
+def is_feature_cache(cache_dir):
+    return os.path.exists(os.path.join(cache_dir, HEADER_NAME))
+
+
+def save_features(cache_dir, features, max_seq_length, vocab_size, output_mode="classification"):
+    """Writes BERT `InputFeatures` or RNN `InputPairFeatures` as a columnar cache."""
+    token_dtype = _token_dtype(vocab_size)
+    label_dtype = np.int64 if output_mode == "classification" else np.float32
+    columns = {}
+    if len(features) > 0 and hasattr(features[0], "input_ids_a"):
+        kind = "pair"
+        for name in ["input_ids_a", "input_ids_b"]:
+            rows = [getattr(f, name) for f in features]
+            lengths = np.array([_pair_length(r) for r in rows], dtype=np.int64)
+            columns[name], columns[name + "_offsets"] = _ragged(rows, lengths, token_dtype)
+    else:
+        kind = "bert"
+        lengths = np.array([sum(f.input_mask) for f in features], dtype=np.int64)
+        columns["input_ids"], columns["offsets"] = _ragged(
+            [f.input_ids for f in features], lengths, token_dtype)
+        columns["segment_ids"], _ = _ragged([f.segment_ids for f in features], lengths, np.int8)
+    columns["label_ids"] = np.array([f.label_id for f in features], dtype=label_dtype)
+    columns["preprob"] = np.array([f.preprob for f in features], dtype=np.float32)
+
+    header = {
+        "version": FORMAT_VERSION,
+        "kind": kind,
+        "num_examples": len(features),
+        "max_seq_length": max_seq_length,
+        "columns": {name: {"dtype": np.dtype(arr.dtype).name, "length": int(arr.shape[0])}
+                    for name, arr in columns.items()},
+    }
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    for name, arr in columns.items():
+        np.ascontiguousarray(arr).tofile(os.path.join(cache_dir, name + ".bin"))
+    with open(os.path.join(cache_dir, HEADER_NAME), "w") as fh:
+        json.dump(header, fh, indent=2)
+
+
+class MemmapFeatureDataset(Dataset):
+    """Dataset over a columnar feature cache.
+
+    Items have the same layout as the `TensorDataset`s built by
+    `run_classifier.get_tensor_dataset`: `(input_ids, input_mask, segment_ids,
+    label_id, preprob)` for BERT caches and `(input_ids_a, input_ids_b,
+    label_id, preprob)` for RNN pair caches, padded to `max_seq_length`.
+    """
+
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, HEADER_NAME)) as fh:
+            self.header = json.load(fh)
+        if self.header["version"] != FORMAT_VERSION:
+            raise ValueError("Unsupported feature cache version %s in %s" % (self.header["version"], cache_dir))
+        self.cache_dir = cache_dir
+        self.kind = self.header["kind"]
+        self.max_seq_length = self.header["max_seq_length"]
+        self.columns = {}
+        for name, spec in self.header["columns"].items():
+            if spec["length"] == 0:
+                self.columns[name] = np.zeros(0, dtype=spec["dtype"])
+            else:
+                self.columns[name] = np.memmap(os.path.join(cache_dir, name + ".bin"), dtype=spec["dtype"],
+                                               mode="r", shape=(spec["length"],))
+
+    def __len__(self):
+        return self.header["num_examples"]
+
+    @property
+    def label_ids(self):
+        return torch.from_numpy(np.array(self.columns["label_ids"]))
+
+    @property
+    def lengths(self):
+        """Number of real tokens of every example."""
+        if self.kind == "bert":
+            return np.diff(self.columns["offsets"])
+        return np.maximum(np.diff(self.columns["input_ids_a_offsets"]),
+                          np.diff(self.columns["input_ids_b_offsets"]))
+
+    def _padded(self, name, offsets, i, dtype=np.int64):
+        out = np.zeros(self.max_seq_length, dtype=dtype)
+        start, end = offsets[i], offsets[i + 1]
+        out[:end - start] = self.columns[name][start:end]
+        return torch.from_numpy(out), end - start
+
+    def __getitem__(self, i):
+        label_id = torch.tensor(self.columns["label_ids"][i])
+        preprob = torch.tensor(self.columns["preprob"][i])
+        if self.kind == "bert":
+            offsets = self.columns["offsets"]
+            input_ids, n = self._padded("input_ids", offsets, i)
+            segment_ids, _ = self._padded("segment_ids", offsets, i)
+            input_mask = torch.zeros(self.max_seq_length, dtype=torch.long)
+            input_mask[:n] = 1
+            return input_ids, input_mask, segment_ids, label_id, preprob
+        input_ids_a, _ = self._padded("input_ids_a", self.columns["input_ids_a_offsets"], i)
+        input_ids_b, _ = self._padded("input_ids_b", self.columns["input_ids_b_offsets"], i)
+        return input_ids_a, input_ids_b, label_id, preprob
+
+
+def file_fingerprint(path, content_hash=False):
+    """Size and mtime of `path`, or its size and sha1 when `content_hash` is set.
+
+    Content hashing costs a full read of the file but survives copies and
+    touches that only change the mtime.
+    """
+    stat = os.stat(path)
+    fingerprint = {"name": os.path.basename(path), "size": stat.st_size}
+    if content_hash:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                sha1.update(block)
+        fingerprint["sha1"] = sha1.hexdigest()
+    else:
+        fingerprint["mtime_ns"] = stat.st_mtime_ns
+    return fingerprint
+
+
+def vocab_fingerprint(vocab):
+    """Hash of a token -> id mapping (BERT `tokenizer.vocab` or the RNN `word2idx` dict)."""
+    sha1 = hashlib.sha1()
+    for token, idx in sorted(vocab.items(), key=lambda kv: (kv[1], kv[0])):
+        sha1.update(("%s\t%d\n" % (token, idx)).encode("utf-8"))
+    return sha1.hexdigest()
+
+
+def cache_key(parts):
+    """Content address of a cache entry: hash of the JSON-encoded `parts`."""
+    blob = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()[:20]
+
+
+def _dir_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+class FeatureCacheStore(object):
+    """Content-addressed directory of converted datasets with LRU eviction.
+
+    Every entry is a directory `<root>/<key>` where `key = cache_key(parts)`.
+    An entry is complete once its `key.json` (holding `parts`) exists; entries
+    are built in a temporary directory and renamed into place, so concurrent
+    runs never see half-written data. The mtime of `key.json` is refreshed on
+    every use and is what eviction orders by.
+    """
+
+    def __init__(self, root, budget_bytes=None):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        if not os.path.exists(root):
+            os.makedirs(root, exist_ok=True)
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def entries(self):
+        """(key, last used, size in bytes) of every complete entry."""
+        out = []
+        for entry in os.scandir(self.root):
+            key_file = os.path.join(entry.path, KEY_NAME)
+            if entry.is_dir() and os.path.exists(key_file):
+                out.append((entry.name, os.stat(key_file).st_mtime, _dir_size(entry.path)))
+        return out
+
+    def load_or_build(self, parts, write_entry, open_entry, desc=""):
+        """Opens the entry for `parts`, building it with `write_entry(path)` on a miss.
+
+        `open_entry(path)` turns the entry directory into the returned object.
+        """
+        key = cache_key(parts)
+        path = self.entry_dir(key)
+        key_file = os.path.join(path, KEY_NAME)
+        if os.path.exists(key_file):
+            logger.info("feature cache hit: %s %s" % (desc, path))
+        else:
+            logger.info("feature cache miss: %s, building %s" % (desc, path))
+            tmp_dir = "%s.tmp-%d" % (path, os.getpid())
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            os.makedirs(tmp_dir)
+            write_entry(tmp_dir)
+            with open(os.path.join(tmp_dir, KEY_NAME), "w") as fh:
+                json.dump(parts, fh, indent=2, sort_keys=True, default=str)
+            try:
+                os.rename(tmp_dir, path)
+            except OSError:
+                # another run built the same entry first; its copy is as good as ours
+                shutil.rmtree(tmp_dir)
+                if not os.path.exists(key_file):
+                    raise
+            self.evict(keep=key)
+        now = time.time()
+        os.utime(key_file, (now, now))
+        return open_entry(path)
+
+    def evict(self, keep=None):
+        """Removes least recently used entries until the store fits its budget."""
+        if self.budget_bytes is None:
+            return
+        entries = sorted(self.entries(), key=lambda e: e[1])
+        total = sum(size for _, _, size in entries)
+        for key, _, size in entries:
+            if total <= self.budget_bytes:
+                break
+            if key == keep:
+                continue
+            logger.info("feature cache evict: %s (%.1f MB)" % (self.entry_dir(key), size / 2 ** 20))
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
@@ -0,0 +1,78 @@
+"""Struct-of-arrays storage for the training set of the sampling experiments.
+
+The sampling experiments re-draw a training subset every epoch from per-label
+pools and re-score every example after each epoch. Instead of keeping the
+features as Python objects (once in a flat list and once more per label), a
+`FeatureTable` holds one tensor per column plus the mutable `weight` and
+`preprob` columns, and `by_label` holds the example indices of every label.
+Subsets drawn for an epoch are `Subset` views of the same tensors.
+"""
+
+import numpy as np
+import torch
+from torch.utils.data import Subset, TensorDataset
+
+# column names of the model inputs, in the order the training loop unpacks them
+BERT_COLUMNS = ("input_ids", "input_mask", "segment_ids")
+PAIR_COLUMNS = ("input_ids_a", "input_ids_b")
+IMAGE_COLUMNS = ("inputs",)
+
+
+class FeatureTable(object):
+    """Feature columns of a converted classification dataset.
+
+    `columns` maps column name to a tensor whose first dimension is the example
+    index. Items of `dataset()` have the same layout as the `TensorDataset`s of
+    `run_classifier.get_tensor_dataset`: the input columns, `label_ids` and,
+    for text features, `preprob`.
+    """
+
+    def __init__(self, columns, label_ids, num_labels, weight=0.01, preprob=0.0):
+        self.columns = columns
+        self.label_ids = label_ids
+        self.num_labels = num_labels
+        self.weight = torch.full((len(label_ids),), weight, dtype=torch.float64)
+        self.preprob = torch.full((len(label_ids),), preprob, dtype=torch.float)
+        labels = label_ids.numpy()
+        self.by_label = [np.flatnonzero(labels == k) for k in range(num_labels)]
+        self._dataset = None
+
+    @classmethod
+    def from_features(cls, features, num_labels):
+        """Builds a table from `InputFeatures` or `InputPairFeatures`."""
+        if len(features) > 0 and hasattr(features[0], "input_ids_a"):
+            names = PAIR_COLUMNS
+        else:
+            names = BERT_COLUMNS
+        columns = {name: torch.tensor([getattr(f, name) for f in features], dtype=torch.long) for name in names}
+        label_ids = torch.tensor([f.label_id for f in features], dtype=torch.long)
+        return cls(columns, label_ids, num_labels)
+
+    @classmethod
+    def from_vectors(cls, vectors, labels, num_labels):
+        """Builds a table from image vectors (kept in their dtype, e.g. raw uint8) and their labels."""
+        columns = {"inputs": torch.as_tensor(np.ascontiguousarray(vectors))}
+        return cls(columns, torch.as_tensor(np.asarray(labels, dtype=np.int64)), num_labels)
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    @property
+    def is_image(self):
+        return "inputs" in self.columns
+
+    def dataset(self):
+        """`TensorDataset` over the whole table; it shares memory with the table."""
+        if self._dataset is None:
+            tensors = list(self.columns.values()) + [self.label_ids]
+            if not self.is_image:
+                tensors.append(self.preprob)
+            self._dataset = TensorDataset(*tensors)
+        return self._dataset
+
+    def subset(self, indices):
+        """View of the examples at `indices` (no feature is copied)."""
+        return Subset(self.dataset(), np.asarray(indices, dtype=np.int64))
+
+    def label_counts(self):
+        return [len(idx) for idx in self.by_label]
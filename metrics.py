@@ -0,0 +1,128 @@
+"""Training metrics that stay on the device until they are needed.
+
+Calling `.item()` / `.tolist()` on a CUDA tensor waits for every queued
+kernel, so logging the loss of every step serializes the host and the GPU.
+`TrainingMetrics` keeps the per-step scalars, the loss sum and the
+per-class probability moments as device tensors and copies them to the host
+in one go every `flush_every` steps (and at the end of an epoch).
+`ScalarWriterThread` then writes the flushed scalars to TensorBoard from a
+background thread.
+"""
+
+import queue
+import resource
+import sys
+import threading
+
+import torch
+
+
+class ScalarWriterThread(object):
+    """Writes batches of `(tag, values, steps)` to a `SummaryWriter` from a background thread."""
+
+    def __init__(self, summary):
+        self.summary = summary
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            tag, values, steps = item
+            for value, step in zip(values, steps):
+                self.summary.add_scalar(tag, value, step)
+
+    def write(self, tag, values, steps):
+        self.queue.put((tag, values, steps))
+
+    def close(self):
+        """Waits until everything queued is written."""
+        self.queue.put(None)
+        self.thread.join()
+        self.summary.flush()
+
+
+class TrainingMetrics(object):
+    """On-device accumulator of the training loss, per-step scalars and class probability moments.
+
+    `add_probs` accumulates, for every class k, the moments of the predicted
+    probability of k over all examples ("total") and over the examples whose
+    label is k ("y=true").
+    """
+
+    def __init__(self, num_labels, device, writer=None, flush_every=100):
+        self.num_labels = num_labels
+        self.device = device
+        self.writer = writer
+        self.flush_every = flush_every
+        self.loss_total = 0.0
+        self._steps = {}
+        self.reset()
+
+    def reset(self):
+        """Starts a new epoch (the loss total runs over the whole training)."""
+        zeros = lambda: torch.zeros(self.num_labels, dtype=torch.float64, device=self.device)
+        self._loss_sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.prob_sum, self.prob_sq_sum, self.prob_count = zeros(), zeros(), zeros()
+        self.true_sum, self.true_sq_sum, self.true_count = zeros(), zeros(), zeros()
+
+    def add_loss(self, loss):
+        self._loss_sum += loss.detach().to(torch.float64)
+
+    def log_step(self, tag, value, step):
+        """Queues the scalar `value` of `tag` at `step`; it reaches TensorBoard on the next flush."""
+        self._steps.setdefault(tag, []).append((torch.as_tensor(value).detach().float(), step))
+
+    def add_probs(self, probs, label_ids):
+        probs = probs.detach().to(torch.float64)
+        self.prob_sum += probs.sum(dim=0)
+        self.prob_sq_sum += (probs * probs).sum(dim=0)
+        self.prob_count += probs.size(0)
+        true_mask = torch.nn.functional.one_hot(label_ids.view(-1), self.num_labels).to(probs.dtype)
+        self.true_sum += (probs * true_mask).sum(dim=0)
+        self.true_sq_sum += (probs * probs * true_mask).sum(dim=0)
+        self.true_count += true_mask.sum(dim=0)
+
+    def step(self, global_step):
+        if self.flush_every > 0 and global_step % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        """Copies the loss and queued scalars to the host (one sync) and hands the scalars to the writer."""
+        self.loss_total += self._loss_sum.item()
+        self._loss_sum.zero_()
+        for tag, entries in self._steps.items():
+            values = torch.stack([value.to(self.device) for value, _ in entries]).tolist()
+            steps = [step for _, step in entries]
+            if self.writer is not None:
+                self.writer.write(tag, values, steps)
+        self._steps = {}
+
+    @staticmethod
+    def _mean_var(total, sq_total, count):
+        mean = total / count.clamp(min=1)
+        # unbiased, like `torch.var`
+        var = (sq_total - count * mean * mean) / (count - 1).clamp(min=1)
+        return mean.tolist(), var.tolist(), count.long().tolist()
+
+    def class_moments(self):
+        """{"total": (mean, var, count), "y=true": (mean, var, count)}, each a per-class list."""
+        return {"total": self._mean_var(self.prob_sum, self.prob_sq_sum, self.prob_count),
+                "y=true": self._mean_var(self.true_sum, self.true_sq_sum, self.true_count)}
+
+    def prob_moments(self):
+        """(mean, var) of all predicted probabilities of the epoch (every class of every example)."""
+        count = self.prob_count.sum()
+        mean = self.prob_sum.sum() / count.clamp(min=1)
+        var = (self.prob_sq_sum.sum() - count * mean * mean) / (count - 1).clamp(min=1)
+        return mean.item(), var.item()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
@@ -0,0 +1,65 @@
+"""Picking the micro-batch size of gradient accumulation from a memory budget.
+
+`probe_micro_batch_size` runs one forward/backward pass per candidate
+micro-batch size, from the whole effective batch down, and returns the largest
+one that fits the budget. Candidates divide the effective batch size, so
+`effective_batch_size // micro_batch_size` accumulation steps give exactly the
+effective batch. On CUDA the memory of a pass is the allocator's peak above
+what was allocated before it; on the CPU, where there is no allocator peak to
+read, it is the size of the activations autograd saves for the backward pass,
+which is the part of the memory that grows with the batch.
+"""
+
+import torch
+
+
+def candidate_sizes(effective_batch_size):
+    """Divisors of `effective_batch_size`, largest first."""
+    return [size for size in range(effective_batch_size, 0, -1) if effective_batch_size % size == 0]
+
+
+def step_memory(step_fn, device, params=()):
+    """Bytes used by `step_fn()` (a forward/backward pass) on `device`; `params` are not counted on the CPU."""
+    device = torch.device(device)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        allocated = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        step_fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - allocated
+
+    param_storages = {p.untyped_storage().data_ptr() for p in params}
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        # views of one activation share its storage, count it once
+        if storage.data_ptr() not in param_storages:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        step_fn()
+    return sum(saved.values())
+
+
+def probe_micro_batch_size(step_fn, effective_batch_size, budget_bytes, device, params=()):
+    """Returns `(size, bytes)` of the largest micro-batch size whose `step_fn(size)` fits `budget_bytes`.
+
+    A size that runs out of memory counts as not fitting.
+    """
+    device = torch.device(device)
+    params = list(params)  # e.g. `model.parameters()`, read once per candidate
+    for size in candidate_sizes(effective_batch_size):
+        try:
+            used = step_memory(lambda: step_fn(size), device, params)
+        except RuntimeError as e:
+            if "out of memory" not in str(e):
+                raise
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+            continue
+        if used <= budget_bytes:
+            return size, used
+    raise ValueError("Even a micro-batch of one example does not fit in %d bytes" % budget_bytes)
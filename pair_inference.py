@@ -0,0 +1,46 @@
+"""Batched inference over the (question, candidate) pairs of WikiQA and SemEval.
+
+The official scorers walk the pairs question by question, in the order of the
+examples. `pair_logits` runs the model over batches of any size and in any
+order and scatters the outputs back to example order, so the scorers see the
+same sequence as with one pair per batch. The batches come from
+`get_eval_dataloader` and are copied to the device one batch ahead by
+`prefetch_to_device`; they are length-sorted with trimmed padding only under
+--dynamic_padding (BERT), since without trimming sorting saves no compute.
+"""
+
+import numpy as np
+import torch
+
+from bucketing import restore_order
+from prefetch import prefetch_to_device
+
+
+def pair_logits(device, eval_dataloader, model, BERT, order=None):
+    """Returns `(logits, label_ids)` arrays of every pair, in example order.
+
+    `order[i]` is the example index of the i-th pair produced by
+    `eval_dataloader` (None: the loader yields the examples in order, as it
+    does without --dynamic_padding).
+    """
+    model.eval()
+    all_logits, all_label_ids = [], []
+    with torch.inference_mode():
+        for batch in prefetch_to_device(eval_dataloader, device):
+            if BERT:
+                input_ids, input_mask, segment_ids, label_ids = batch[:4]
+                logits = model(input_ids, segment_ids, input_mask, labels=None)[0]
+            else:
+                input_ids_a, input_ids_b, label_ids = batch[:3]
+                logits = model(input_ids_a, input_ids_b)
+            all_logits.append(logits.float())
+            all_label_ids.append(label_ids)
+    logits = restore_order(torch.cat(all_logits).cpu().numpy(), order)
+    label_ids = restore_order(torch.cat(all_label_ids).cpu().numpy(), order)
+    return logits, label_ids
+
+
+def softmax_rows(logits):
+    """Row-wise softmax, computed like the scorers' `softmax` of a single row."""
+    exp = np.exp(logits)
+    return exp / np.sum(exp, axis=1, keepdims=True)
@@ -0,0 +1,44 @@
+"""Host-to-device batch transfer that overlaps with compute.
+
+`prefetch_to_device` yields the batches of a loader already on the device
+and issues the copy of the next batch before the current one is handed to
+the step. On CUDA the copies are non-blocking and run on a side stream, so
+with a pinned-memory loader they overlap with the kernels of the current
+step; on the CPU the batches are passed through as they are.
+"""
+
+import torch
+
+
+def to_device(batch, device, non_blocking=False):
+    return tuple(t.to(device, non_blocking=non_blocking) for t in batch)
+
+
+def prefetch_to_device(loader, device):
+    """Yields the batches (tuples of tensors) of `loader` on `device`, one batch ahead."""
+    device = torch.device(device)
+    if device.type != "cuda":
+        for batch in loader:
+            yield to_device(batch, device)
+        return
+
+    stream = torch.cuda.Stream(device)
+    batches = iter(loader)
+
+    def load_next():
+        batch = next(batches, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(stream):
+            return to_device(batch, device, non_blocking=True)
+
+    next_batch = load_next()
+    while next_batch is not None:
+        current_stream = torch.cuda.current_stream(device)
+        current_stream.wait_stream(stream)
+        batch = next_batch
+        for t in batch:
+            # the memory was allocated on the side stream but is used on the current one
+            t.record_stream(current_stream)
+        next_batch = load_next()
+        yield batch
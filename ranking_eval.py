@@ -1,46 +1,38 @@
+"""Response selection metrics (recall@k and MRR) of the Ubuntu (DSTC7) data.
 
-def sort_by_score(val):
-    return val[1]
+The candidates of an example are the consecutive pairs whose ids ("eid_rid")
+share the example id. Their scores are laid out as one padded
+[n_examples, max_candidates] tensor, padding last, and ranked with one
+(stable) sort, so every metric is a count over the ranks of the answers and
+examples may have any number of candidates.
+"""
 
+import numpy as np
+import torch
 
-def ranking_eval(labels, probs, ids):
-    n_exam = 0
 
-    t_mrr = 0
-    t_r1 = 0
-    t_r10 = 0
-    t_r50 = 0
-    temp = []
-    pre_eid = ids[0].split("_")[0]
-    for i, e in enumerate(ids):
-        eid, rid = e.split("_")
-        if pre_eid != eid:  # new example
-            n_exam += 1
-            assert len(temp) == 100 or len(temp) == 10  # candidates num
-            temp.sort(key=sort_by_score, reverse=True)
-            for j, t in enumerate(temp, 1):
-                if t[2] == 1:  # if answer
-                    t_mrr += 1/j
-                    if j <= 50:
-                        t_r50 += 1
-                    if j <= 10:
-                        t_r10 += 1
-                    if j <= 1:
-                        t_r1 += 1
-            temp = []
-        temp.append([rid, probs[i][1], labels[i]])
-        pre_eid = eid
-    n_exam += 1
-    assert len(temp) == 100 or len(temp) == 10  # candidates num
-    temp.sort(key=sort_by_score, reverse=True)
-    for j, t in enumerate(temp, 1):
-        if t[2] == 1:  # if answer
-            t_mrr += 1/j
-            if j <= 50:
-                t_r50 += 1
-            if j <= 10:
-                t_r10 += 1
-            if j <= 1:
-                t_r1 += 1
+def ranking_eval(labels, probs, ids, ks=(1, 10, 50)):
+    """Returns a dict with the recall `R@k` for every k in `ks` and the `MRR`.
 
-    return t_r1/n_exam, t_r10/n_exam, t_r50/n_exam, t_mrr/n_exam
+    `probs[i][1]` is the score of pair `ids[i]` and `labels[i] == 1` marks an
+    answer. Every answer counts, so with several answers per example recall
+    may exceed 1. Equal scores keep the order of the pairs.
+    """
+    eids = np.array([i.split("_")[0] for i in ids])
+    new_example = np.concatenate([[True], eids[1:] != eids[:-1]])
+    example = np.cumsum(new_example) - 1
+    starts = np.flatnonzero(new_example)
+    position = np.arange(len(ids)) - starts[example]
+    n_exam, max_candidates = len(starts), position.max() + 1
+
+    example, position = torch.from_numpy(example), torch.from_numpy(position)
+    scores = torch.full((n_exam, max_candidates), float('-inf'), dtype=torch.float64)
+    scores[example, position] = torch.as_tensor(np.asarray(probs)[:, 1], dtype=torch.float64)
+    is_answer = torch.zeros((n_exam, max_candidates), dtype=torch.bool)
+    is_answer[example, position] = torch.as_tensor(np.asarray(labels) == 1)
+
+    order = scores.sort(dim=1, descending=True, stable=True).indices
+    ranks = torch.arange(1, max_candidates + 1, dtype=torch.float64).expand(n_exam, -1)[is_answer.gather(1, order)]
+    results = {'R@%d' % k: (ranks <= k).sum().item() / n_exam for k in ks}
+    results['MRR'] = (1.0 / ranks).sum().item() / n_exam
+    return results
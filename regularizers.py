@@ -0,0 +1,86 @@
+"""Regularizers on the predicted class distribution of a mini-batch.
+
+`ClassDistributionRegularizer` implements the `--KLD_rg` and `--mu_rg`
+penalties on the softmax outputs `probs` (batch x num_labels). Per-class
+means and variances come from one reduction over the batch and everything,
+including the choice of the classes with the smallest and largest variance,
+stays on the device, so adding the penalty never waits for the step.
+"""
+
+import math
+
+import torch
+import torch.nn as nn
+
+
+class ClassDistributionRegularizer(nn.Module):
+    """Symmetric KL ("KLD") and mean divergence ("mu") penalties on the class probabilities.
+
+    - KLD: the predicted probability of every class is treated as a Gaussian
+      over the batch; the penalty is the symmetric KL divergence between the
+      classes of smallest and largest variance, skipped when it is not below
+      `max_kld`.
+    - mu: mean over the classes of |1 / num_labels - mean probability|.
+
+    Both are weighted by their lambda times the decay of the epoch:
+    'none' (1), 'exp' (exp(-decay_rate * epoch)) or 'step'
+    (1 - step_drop * floor(epoch / step_size)).
+    """
+
+    def __init__(self, num_labels, kld=False, mu=False, lambda_kld=0.001, lambda_mu=0.0001,
+                 decay='none', decay_rate=0.01, step_size=20, step_drop=0.1, max_kld=20.0):
+        super(ClassDistributionRegularizer, self).__init__()
+        if decay not in ('none', 'exp', 'step'):
+            raise ValueError("Unknown lambda decay: %s" % decay)
+        self.num_labels = num_labels
+        self.kld = kld
+        self.mu = mu
+        self.lambda_kld = lambda_kld
+        self.lambda_mu = lambda_mu
+        self.decay = decay
+        self.decay_rate = decay_rate
+        self.step_size = step_size
+        self.step_drop = step_drop
+        self.max_kld = max_kld
+
+    def decay_factor(self, epoch):
+        if self.decay == 'exp':
+            return math.exp(-self.decay_rate * epoch)
+        if self.decay == 'step':
+            return 1 - self.step_drop * math.floor(epoch / self.step_size)
+        return 1.0
+
+    def forward(self, probs, epoch):
+        """Returns `(penalty, kld, mu)`; `kld` / `mu` are None when that regularizer is off.
+
+        `kld` is also None for a single example, which still gets the mu penalty.
+        """
+        penalty = probs.new_zeros(())
+        kld = mu = None
+        decay = self.decay_factor(epoch)
+        # the variance of a single example is undefined, so it gets no KLD penalty
+        use_kld = self.kld and probs.size(0) >= 2
+        if use_kld:
+            var, mean = torch.var_mean(probs, dim=0)
+        else:
+            mean = probs.mean(dim=0)
+
+        if use_kld:
+            max_idx, min_idx = var.argmax(), var.argmin()
+            var_max, var_min = var[max_idx], var[min_idx]
+            diff = mean[max_idx] - mean[min_idx]
+            # 0.5 * (KL(min || max) + KL(max || min)) of two Gaussians; the log terms cancel
+            defined = (var_min > 0) & (var_max > 0)
+            # keeps the gradient finite where the divergence is not defined (and not used)
+            var_max = torch.where(defined, var_max, torch.ones_like(var_max))
+            var_min = torch.where(defined, var_min, torch.ones_like(var_min))
+            kld = 0.25 * ((var_min + diff * diff) / var_max + (var_max + diff * diff) / var_min - 2)
+            kld = torch.where(defined, kld, torch.full_like(kld, float('inf')))
+            use = defined & (kld < self.max_kld)
+            penalty = penalty + torch.where(use, self.lambda_kld * decay * kld, torch.zeros_like(kld))
+
+        if self.mu:
+            mu = (mean - 1.0 / self.num_labels).abs().mean()
+            penalty = penalty + self.lambda_mu * decay * mu
+
+        return penalty, kld, mu
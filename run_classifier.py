@@ -18,12 +18,16 @@
 from __future__ import absolute_import, division, print_function
 
 import argparse
+import contextlib
+import functools
 import glob
 import json
 import logging
+import multiprocessing
 import os
 import random
 import sys
+import time
 
 import numpy as np
 import math
@@ -31,6 +35,8 @@ import torch
 import torch.nn as nn
 from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler, TensorDataset)
 from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data.dataloader import default_collate
+from torch.nn.parallel import DistributedDataParallel
 from tqdm import tqdm, trange
 
 from torch.nn import CrossEntropyLoss, MSELoss, Sigmoid, KLDivLoss, Softmax, LogSoftmax, BCEWithLogitsLoss, TripletMarginLoss, SoftMarginLoss
@@ -44,6 +50,19 @@ from data_processor import *
 from wikiqa_eval import wikiqa_eval
 from semeval_eval import semeval_eval
 from ranking_eval import ranking_eval
+from prefetch import prefetch_to_device, to_device
+from micro_batch import probe_micro_batch_size
+from regularizers import ClassDistributionRegularizer
+from checkpoint import CheckpointWriter, rng_state, set_rng_state
+from cpu_affinity import core_groups, pin_to_cores
+from metrics import ScalarWriterThread, TrainingMetrics, peak_rss_mb
+from bucketing import BucketBatchSampler, PaddingStats, dataset_lengths, trim_bert_batch
+from feature_table import FeatureTable
+from streaming import StreamingDataset, count_examples
+from tokenization_cache import CachedTokenizer, log_tokenization_stats
+from feature_assembly import assemble_bert_inputs
+from feature_cache import (FeatureCacheStore, MemmapFeatureDataset, save_features, file_fingerprint,
+                           vocab_fingerprint)
 from ploting.output_ploting import plot_samples, plot_out_dist, plot_vector_bar
 
 from setproctitle import setproctitle
@@ -62,12 +81,33 @@ from transformers import (
     get_linear_schedule_with_warmup,
 )
 
-spacy_en = spacy.load('en_core_web_sm')
+_spacy_en = None
+
+
+def get_spacy_en():
+    """The spaCy English model, loaded on first use (BERT and image runs never load it)."""
+    global _spacy_en
+    if _spacy_en is None:
+        _spacy_en = spacy.load('en_core_web_sm')
+    return _spacy_en
 
 
 class simple_tokenizer():
     def tokenize(self, text):
-        return [tok.text for tok in spacy_en.tokenizer(text)]
+        return [tok.text for tok in get_spacy_en().tokenizer(text)]
+
+    def tokenize_batch(self, texts, n_process=1, batch_size=1000):
+        """Tokenizes `texts` in batches (on `n_process` processes); only the tokenizer of the pipeline runs."""
+        nlp = get_spacy_en()
+        docs = nlp.pipe(texts, disable=nlp.pipe_names, n_process=n_process, batch_size=batch_size)
+        return [[tok.text for tok in doc] for doc in docs]
+
+
+def tokenize_texts(tokenizer, texts, n_process=1):
+    """Tokenizes a list of texts, in batches if the tokenizer supports it."""
+    if hasattr(tokenizer, "tokenize_batch"):
+        return tokenizer.tokenize_batch(texts, n_process=n_process)
+    return [tokenizer.tokenize(text) for text in texts]
 
 
 setproctitle("(bosung) bert classifier")
@@ -76,6 +116,11 @@ logger = logging.getLogger(__name__)
 nnSoftmax = Softmax(dim=0)
 nnLogSoftmax = LogSoftmax(dim=0)
 
+# number of examples whose BERT inputs are assembled together (see `_convert_example_batch`)
+CONVERT_BATCH_SIZE = 1000
+# training state written after every epoch under --resume
+TRAINING_STATE_NAME = "training_state.bin"
+
 
 class InputFeatures(object):
     """A single set of features of data."""
@@ -111,24 +156,21 @@ class InputPairFeatures(object):
 
 
 def divide_features_by_label(examples, labels):
-    features = []
-    features_by_label = [[], []]
-    for vector, label in zip(examples, labels):
-        features.append(SimpleFeatures(vector, label))
-        if label == 0:  # cat
-            features_by_label[0].append(SimpleFeatures(vector, 0))
-        else:
-            assert label == 1  # dog
-            features_by_label[1].append(SimpleFeatures(vector, 1))
+    """Builds the `FeatureTable` of binary image data (label 0: cat, label 1: dog)."""
+    table = FeatureTable.from_vectors(examples, labels, num_labels=2)
+    assert len(table) == sum(table.label_counts())
 
-    print("[CIFAR-10 (Binary) ] (train) label 0: %d  / label 1: %d" % (
-        len(features_by_label[0]), len(features_by_label[1])))
-    return features, features_by_label
+    print("[CIFAR-10 (Binary) ] (train) label 0: %d  / label 1: %d" % tuple(table.label_counts()))
+    return table
 
 
 def convert_examples_to_features_rnn(word2idx_dict, examples, label_list, _max_seq_length,
-                                     tokenizer, output_mode, sep=False):
-    """Loads a data file into a list of `InputBatch`s."""
+                                     tokenizer, output_mode, sep=False, num_workers=1):
+    """Loads a data file into a list of `InputBatch`s.
+
+    The texts of all examples are tokenized up front in batches, on `num_workers`
+    processes.
+    """
 
     def _word2idx(tokens):
         ids = []
@@ -143,13 +185,15 @@ def convert_examples_to_features_rnn(word2idx_dict, examples, label_list, _max_s
 
     label_map = {label: i for i, label in enumerate(label_list)}
 
+    all_tokens_a = tokenize_texts(tokenizer, [example.text_a for example in examples], n_process=num_workers)
+    all_tokens_b = tokenize_texts(tokenizer, [example.text_b for example in examples], n_process=num_workers)
+
     features = []
-    features_by_label = [[] for _ in range(len(label_list))]  # [[label 0 data], [label 1 data] ... []]
 
     for ex_index, example in enumerate(examples):
 
-        tokens_a = tokenizer.tokenize(example.text_a)
-        tokens_b = tokenizer.tokenize(example.text_b)
+        tokens_a = all_tokens_a[ex_index]
+        tokens_b = all_tokens_b[ex_index]
 
         input_ids_a = _word2idx(tokens_a)
         input_ids_b = _word2idx(tokens_b)
@@ -192,86 +236,93 @@ def convert_examples_to_features_rnn(word2idx_dict, examples, label_list, _max_s
         features.append(
             InputPairFeatures(input_ids_a=input_ids_a, input_ids_b=input_ids_b, label_id=label_id))
 
-        features_by_label[label_id].append(
-            InputPairFeatures(input_ids_a=input_ids_a, input_ids_b=input_ids_b, label_id=label_id))
-
+    log_tokenization_stats(tokenizer, logger)
     if sep is False:
         return features
     else:
-        assert len(features) == (len(features_by_label[0]) + len(features_by_label[1]))
-        logger.info(" total:  %d\tlabel 0: %d\tlabel 1: %d " % (
-            len(features), len(features_by_label[0]), len(features_by_label[1])))
-        return features, features_by_label
+        return _feature_table(features, label_list)
 
 
 def convert_examples_to_features(examples, label_list, max_seq_length,
-                                 tokenizer, output_mode, sep=False):
-    """Loads a data file into a list of `InputBatch`s."""
-
-    label_map = {label: i for i, label in enumerate(label_list)}
-
-    features = []
-    features_by_label = [[] for _ in range(len(label_list))]  # [[label 0 data], [label 1 data] ... []]
-
-    for (ex_index, example) in enumerate(examples):
-        if ex_index % 10000 == 0:
-            logger.info("Writing example %d of %d" % (ex_index, len(examples)))
+                                 tokenizer, output_mode, sep=False, num_workers=1, chunk_size=None):
+    """Loads a data file into a list of `InputBatch`s.
 
-        tokens_a = tokenizer.tokenize(example.text_a)
+    With `num_workers` > 1 the examples are split into chunks and converted on a
+    process pool; the features come back in the original example order.
+    """
 
-        tokens_b = None
-        if example.text_b:
-            tokens_b = tokenizer.tokenize(example.text_b)
-            # Modifies `tokens_a` and `tokens_b` in place so that the total
-            # length is less than the specified length.
-            # Account for [CLS], [SEP], [SEP] with "- 3"
-            _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
-        else:
-            # Account for [CLS] and [SEP] with "- 2"
-            if len(tokens_a) > max_seq_length - 2:
-                tokens_a = tokens_a[:(max_seq_length - 2)]
-
-        # The convention in BERT is:
-        # (a) For sequence pairs:
-        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-        #  type_ids: 0   0  0    0    0     0       0 0    1  1  1  1   1 1
-        # (b) For single sequences:
-        #  tokens:   [CLS] the dog is hairy . [SEP]
-        #  type_ids: 0   0   0   0  0     0 0
-        #
-        # Where "type_ids" are used to indicate whether this is the first
-        # sequence or the second sequence. The embedding vectors for `type=0` and
-        # `type=1` were learned during pre-training and are added to the wordpiece
-        # embedding vector (and position vector). This is not *strictly* necessary
-        # since the [SEP] token unambiguously separates the sequences, but it makes
-        # it easier for the model to learn the concept of sequences.
-        #
-        # For classification tasks, the first vector (corresponding to [CLS]) is
-        # used as as the "sentence vector". Note that this only makes sense because
-        # the entire model is fine-tuned.
-        tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
-        segment_ids = [0] * len(tokens)
-
-        if tokens_b:
-            tokens += tokens_b + ["[SEP]"]
-            segment_ids += [1] * (len(tokens_b) + 1)
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        padding = [0] * (max_seq_length - len(input_ids))
-        input_ids += padding
-        input_mask += padding
-        segment_ids += padding
+    label_map = {label: i for i, label in enumerate(label_list)}
 
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
+    if num_workers > 1 and len(examples) > 1:
+        features = _convert_examples_parallel(examples, label_map, max_seq_length, tokenizer, output_mode,
+                                              num_workers, chunk_size)
+    else:
+        features = []
+        for start in range(0, len(examples), CONVERT_BATCH_SIZE):
+            if start % 10000 == 0:
+                logger.info("Writing example %d of %d" % (start, len(examples)))
+            features.extend(_convert_example_batch(start, examples[start:start + CONVERT_BATCH_SIZE],
+                                                   label_map, max_seq_length, tokenizer, output_mode))
+
+    log_tokenization_stats(tokenizer, logger)
+    if sep is False:
+        return features
+    else:
+        return _feature_table(features, label_list)
+
+
+def _feature_table(features, label_list):
+    """Packs the features of a sampling experiment (`sep=True`) into one `FeatureTable`."""
+    table = FeatureTable.from_features(features, num_labels=len(label_list))
+    label_counts = table.label_counts()
+    assert len(table) == sum(label_counts)
+    logger.info(" total:  %d\tlabel 0: %d\tlabel 1: %d " % (len(table), label_counts[0], label_counts[1]))
+    return table
+
+
+def _convert_single_example(ex_index, example, label_map, max_seq_length, tokenizer, output_mode):
+    """Converts one `InputExample` into `InputFeatures`."""
+    return _convert_example_batch(ex_index, [example], label_map, max_seq_length, tokenizer, output_mode)[0]
+
+
+def _convert_example_batch(start, examples, label_map, max_seq_length, tokenizer, output_mode):
+    """Converts a batch of `InputExample`s (numbered from `start`) into `InputFeatures`.
+
+    Examples are tokenized one by one; truncation and layout are then done for
+    the whole batch at once by `assemble_bert_inputs`.
+    """
+    # The convention in BERT is:
+    # (a) For sequence pairs:
+    #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
+    #  type_ids: 0   0  0    0    0     0       0 0    1  1  1  1   1 1
+    # (b) For single sequences:
+    #  tokens:   [CLS] the dog is hairy . [SEP]
+    #  type_ids: 0   0   0   0  0     0 0
+    #
+    # Where "type_ids" are used to indicate whether this is the first
+    # sequence or the second sequence. The embedding vectors for `type=0` and
+    # `type=1` were learned during pre-training and are added to the wordpiece
+    # embedding vector (and position vector). This is not *strictly* necessary
+    # since the [SEP] token unambiguously separates the sequences, but it makes
+    # it easier for the model to learn the concept of sequences.
+    #
+    # For classification tasks, the first vector (corresponding to [CLS]) is
+    # used as as the "sentence vector". Note that this only makes sense because
+    # the entire model is fine-tuned.
+    ids_a, ids_b = [], []
+    for example in examples:
+        ids_a.append(tokenizer.convert_tokens_to_ids(tokenizer.tokenize(example.text_a)))
+        ids_b.append(tokenizer.convert_tokens_to_ids(tokenizer.tokenize(example.text_b)) if example.text_b else [])
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+
+    # The mask has 1 for real tokens and 0 for padding tokens. Only real
+    # tokens are attended to. Everything is zero-padded up to the sequence length.
+    input_ids, input_mask, segment_ids = assemble_bert_inputs(
+        ids_a, ids_b, [bool(example.text_b) for example in examples], max_seq_length, cls_id, sep_id)
+    input_ids, input_mask, segment_ids = input_ids.tolist(), input_mask.tolist(), segment_ids.tolist()
 
+    features = []
+    for i, example in enumerate(examples):
         if output_mode == "classification":
             label_id = label_map[example.label]
         elif output_mode == "regression":
@@ -279,53 +330,69 @@ def convert_examples_to_features(examples, label_list, max_seq_length,
         else:
             raise KeyError(output_mode)
 
-        if ex_index < 5:
+        if start + i < 5:
             logger.info("*** Example ***")
             logger.info("guid: %s" % (example.guid))
             logger.info("tokens: %s" % " ".join(
-                [str(x) for x in tokens]))
-            logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-            logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
+                [str(x) for x in tokenizer.convert_ids_to_tokens(input_ids[i][:sum(input_mask[i])])]))
+            logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids[i]]))
+            logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask[i]]))
             logger.info(
-                "segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
+                "segment_ids: %s" % " ".join([str(x) for x in segment_ids[i]]))
             logger.info("label: %s (id = %d)" % (example.label, label_id))
 
-        features.append(
-            InputFeatures(input_ids=input_ids,
-                          input_mask=input_mask,
-                          segment_ids=segment_ids,
-                          label_id=label_id))
+        features.append(InputFeatures(input_ids=input_ids[i],
+                                      input_mask=input_mask[i],
+                                      segment_ids=segment_ids[i],
+                                      label_id=label_id))
+    return features
 
-        features_by_label[label_id].append(
-            InputFeatures(input_ids=input_ids,
-                          input_mask=input_mask,
-                          segment_ids=segment_ids,
-                          label_id=label_id))
 
-    if sep is False:
-        return features
-    else:
-        assert len(features) == (len(features_by_label[0]) + len(features_by_label[1]))
-        logger.info(" total:  %d\tlabel 0: %d\tlabel 1: %d " % (
-            len(features), len(features_by_label[0]), len(features_by_label[1])))
-        return features, features_by_label
-
-
-def _truncate_seq_pair(tokens_a, tokens_b, max_length):
-    """Truncates a sequence pair in place to the maximum length."""
-
-    # This is a simple heuristic which will always truncate the longer sequence
-    # one token at a time. This makes more sense than truncating an equal percent
-    # of tokens from each, since if one sequence is very short then each token
-    # that's truncated likely contains more information than a longer sequence.
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        if len(tokens_a) > len(tokens_b):
-            tokens_a.pop()
-        else:
-            tokens_b.pop()
+def _example_to_tensors(label_map, max_seq_length, tokenizer, output_mode, ex_index, example):
+    """Converts one `InputExample` into the tensors of a `get_tensor_dataset` item (for `--streaming`)."""
+    feature = _convert_single_example(ex_index, example, label_map, max_seq_length, tokenizer, output_mode)
+    label_dtype = torch.long if output_mode == "classification" else torch.float
+    return (torch.tensor(feature.input_ids, dtype=torch.long),
+            torch.tensor(feature.input_mask, dtype=torch.long),
+            torch.tensor(feature.segment_ids, dtype=torch.long),
+            torch.tensor(feature.label_id, dtype=label_dtype),
+            torch.tensor(feature.preprob, dtype=torch.float))
+
+
+# conversion settings shared by every chunk a pool worker converts (set by `_init_convert_worker`)
+_convert_worker_args = None
+
+
+def _init_convert_worker(label_map, max_seq_length, tokenizer, output_mode):
+    global _convert_worker_args
+    _convert_worker_args = (label_map, max_seq_length, tokenizer, output_mode)
+
+
+def _convert_example_chunk(chunk):
+    start, examples = chunk
+    features = []
+    for i in range(0, len(examples), CONVERT_BATCH_SIZE):
+        features.extend(_convert_example_batch(start + i, examples[i:i + CONVERT_BATCH_SIZE], *_convert_worker_args))
+    return features
+
+
+def _convert_examples_parallel(examples, label_map, max_seq_length, tokenizer, output_mode,
+                               num_workers, chunk_size=None):
+    """Converts `examples` on `num_workers` processes, keeping the input order."""
+    if chunk_size is None:
+        # a few chunks per worker keeps them busy without paying pickling overhead per example
+        chunk_size = max(1, min(10000, math.ceil(len(examples) / (num_workers * 4))))
+    chunks = [(i, examples[i:i + chunk_size]) for i in range(0, len(examples), chunk_size)]
+    logger.info("Converting %d examples on %d workers (%d chunks)" % (len(examples), num_workers, len(chunks)))
+
+    features = []
+    with multiprocessing.Pool(num_workers, initializer=_init_convert_worker,
+                              initargs=(label_map, max_seq_length, tokenizer, output_mode)) as pool:
+        # imap yields chunk results in submission order, so features stay aligned with examples
+        for chunk_features in pool.imap(_convert_example_chunk, chunks):
+            features.extend(chunk_features)
+            logger.info("Writing example %d of %d" % (len(features), len(examples)))
+    return features
 
 
 def simple_accuracy(preds, labels):
@@ -368,11 +435,7 @@ def ranking_metric(preds, labels, probs, ids):
     if ids is None:
         return results
     else:
-        r1, r10, r50, mrr = ranking_eval(labels, probs, ids)
-        results['R@1'] = r1
-        results['R@10'] = r10
-        results['R@50'] = r50
-        results['MRR'] = mrr
+        results.update(ranking_eval(labels, probs, ids))
         return results
 
 
@@ -519,6 +582,8 @@ def tokenizer_loader(args, device, num_labels, pre_trained=False, embeddings=Non
     else:
         tokenizer = simple_tokenizer()
 
+    if tokenizer is not None and args.tokenize_cache_size > 0:
+        tokenizer = CachedTokenizer(tokenizer, max_size=args.tokenize_cache_size)
     return tokenizer
 
 
@@ -577,7 +642,8 @@ def main():
     parser.add_argument("--eval_batch_size",
                         default=128,
                         type=int,
-                        help="Total batch size for eval.")
+                        help="Batch size of the inference passes (dev/test evaluation and update_probs). Nothing is "
+                             "kept for a backward pass, so it can be much larger than the training batch.")
     parser.add_argument("--learning_rate",
                         default=5e-5,
                         type=float,
@@ -594,10 +660,15 @@ def main():
     parser.add_argument("--no_cuda",
                         action='store_true',
                         help="Whether not to use CUDA when available")
-    parser.add_argument("--local_rank",
+    parser.add_argument("--local_rank", "--local-rank",
                         type=int,
                         default=-1,
-                        help="local_rank for distributed training on gpus")
+                        help="local_rank for distributed training on gpus, or on CPU core groups (gloo) with "
+                             "--no_cuda. Read from $LOCAL_RANK when launched with torchrun.")
+    parser.add_argument('--scaling_baseline',
+                        type=float, default=0,
+                        help="Training throughput (examples/s) of a single process run with the same settings; "
+                             "distributed runs then report their scaling efficiency against it.")
     parser.add_argument('--seed',
                         type=int,
                         default=42,
@@ -606,6 +677,52 @@ def main():
                         type=int,
                         default=1,
                         help="Number of updates steps to accumulate before performing a backward/update pass.")
+    parser.add_argument('--auto_micro_batch',
+                        action='store_true',
+                        help="Pick the largest micro-batch size (a divisor of --train_batch_size) whose forward and "
+                             "backward pass fits in --memory_budget_mb, and accumulate gradients over "
+                             "train_batch_size / micro-batch steps. Overrides --gradient_accumulation_steps.")
+    parser.add_argument('--memory_budget_mb',
+                        type=float, default=0,
+                        help="Memory budget of one micro-batch for --auto_micro_batch: peak allocation above the "
+                             "model and optimizer on CUDA, activations saved for backward on the CPU.")
+    parser.add_argument('--lr_schedule',
+                        default='constant', choices=['constant', 'linear'],
+                        help="Learning rate schedule over the optimizer steps: constant, or linear decay after "
+                             "--warmup_proportion of linear warmup.")
+    parser.add_argument('--eval_every_steps',
+                        type=int, default=0,
+                        help="Evaluate on the dev set (and checkpoint) every N optimizer steps (of "
+                             "--gradient_accumulation_steps micro-batches each) instead of after every epoch. "
+                             "0 evaluates after every epoch.")
+    parser.add_argument('--early_stopping_patience',
+                        type=int, default=0,
+                        help="Stop training after this many dev evaluations in a row without improvement. "
+                             "0 disables early stopping.")
+    parser.add_argument('--min_delta',
+                        type=float, default=0.0,
+                        help="Smallest increase of the dev score that counts as an improvement for early stopping.")
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help="Write the complete training state (model, optimizer, scheduler, counters, RNG states, "
+                             "sampling weights, dev results) to output_dir after every epoch, and continue from it "
+                             "if it is already there.")
+    parser.add_argument('--keep_best_checkpoints',
+                        type=int, default=0,
+                        help="Keep only this many epoch checkpoints with the best dev score (plus the latest one); "
+                             "0 keeps all of them.")
+    parser.add_argument('--checkpoint_fp16',
+                        action='store_true',
+                        help="Store the floating point weights of the epoch checkpoints in fp16 "
+                             "(load_state_dict casts them back to the model's dtype).")
+    parser.add_argument('--lean_step',
+                        action='store_true',
+                        help="Free the autograd graph after every backward pass (no retain_graph) and free the "
+                             "gradients after every optimizer step instead of zeroing them.")
+    parser.add_argument('--precision',
+                        default='fp32', choices=['fp32', 'bf16'],
+                        help="Precision of the forward passes (training, evaluation, update_probs). bf16 runs them "
+                             "under bfloat16 autocast; the weights and the optimizer state stay in fp32.")
     parser.add_argument('--fp16',
                         action='store_true',
                         help="Whether to use 16-bit float precision instead of 32-bit")
@@ -614,6 +731,63 @@ def main():
                         help="Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True.\n"
                              "0 (default value): dynamic loss scaling.\n"
                              "Positive power of 2: static loss scaling value.\n")
+    parser.add_argument('--preprocess_workers',
+                        type=int, default=1,
+                        help="Number of processes used to convert examples to features. "
+                             "Features keep the example order, so the result matches a single process run.")
+    parser.add_argument('--tokenize_cache_size',
+                        type=int, default=100000,
+                        help="Number of distinct texts whose tokenization is memoized (LRU); "
+                             "questions repeated over their candidates are tokenized once. 0 disables the cache.")
+    parser.add_argument('--metrics_flush_steps',
+                        type=int, default=100,
+                        help="Copy the on-device training metrics to the host and TensorBoard every N steps "
+                             "(and at the end of every epoch).")
+    parser.add_argument('--num_workers',
+                        type=int, default=0,
+                        help="Number of DataLoader worker processes preparing batches (0: in the main process).")
+    parser.add_argument('--pin_memory',
+                        action='store_true',
+                        help="Collate batches into pinned memory so host-to-GPU copies are asynchronous.")
+    parser.add_argument('--persistent_workers',
+                        action='store_true',
+                        help="Keep DataLoader workers alive between epochs (with --num_workers > 0).")
+    parser.add_argument('--prefetch_factor',
+                        type=int, default=2,
+                        help="Number of batches every DataLoader worker prepares ahead.")
+    parser.add_argument('--streaming',
+                        action='store_true',
+                        help="(BERT) Read and convert the training set on the fly in DataLoader workers "
+                             "instead of loading it into memory (memory stays constant in the corpus size).")
+    parser.add_argument('--shuffle_buffer',
+                        type=int, default=10000,
+                        help="Number of examples each worker shuffles over with --streaming.")
+    parser.add_argument('--feature_cache_dir',
+                        type=str, default='',
+                        help="Where converted datasets are cached (default: <data_dir>/feature_cache).")
+    parser.add_argument('--feature_cache_budget_gb',
+                        type=float, default=20.0,
+                        help="Disk budget of the feature cache; least recently used entries are evicted "
+                             "beyond it. 0 disables eviction.")
+    parser.add_argument('--cache_content_hash',
+                        action='store_true',
+                        help="Key cached features by the sha1 of the input files instead of their mtime.")
+    parser.add_argument('--dynamic_padding',
+                        action='store_true',
+                        help="(BERT) Batch examples of similar length together and trim every batch to its "
+                             "longest sequence instead of padding to max_seq_length.")
+    parser.add_argument('--bucket_size',
+                        type=int, default=100,
+                        help="Number of batches per length bucket with --dynamic_padding; batches are "
+                             "shuffled within and across buckets.")
+    parser.add_argument('--imbalance_ratio',
+                        type=float, default=None,
+                        help="(image tasks) Keep n_major / ratio training images of every minor class "
+                             "instead of the processor's default count (e.g. 5 or 10).")
+    parser.add_argument('--imbalance_seed',
+                        type=int, default=None,
+                        help="(image tasks) Shuffle every class with this seed before taking the dev and train "
+                             "images; by default the first images of every class are taken.")
     parser.add_argument('--do_sampling', type=bool, default=False)
     parser.add_argument('--sampling_method', type=str, default='random', choices=['random', 'weighted', 'top-k', 'border', 'tardy'])
     parser.add_argument('--do_histloss', type=bool, default=False)
@@ -629,6 +803,13 @@ def main():
     parser.add_argument('--MNIST', type=bool, default=False)
     parser.add_argument('--tb_log_dir', type=str, default='runs')
     parser.add_argument('--lambda_decay', type=str, default='none', choices=['none', 'exp', 'step'])
+    parser.add_argument('--lambda_kld', type=float, default=0.001, help="weight of the KLD_rg penalty")
+    parser.add_argument('--lambda_mu', type=float, default=0.0001, help="weight of the mu_rg penalty")
+    parser.add_argument('--lambda_decay_rate', type=float, default=0.01,
+                        help="exp decay: lambda * exp(-rate * epoch)")
+    parser.add_argument('--lambda_decay_step_size', type=int, default=20,
+                        help="step decay: lambda * (1 - drop * floor(epoch / step_size))")
+    parser.add_argument('--lambda_decay_step_drop', type=float, default=0.1)
     args = parser.parse_args()
 
     processors = {
@@ -676,9 +857,21 @@ def main():
         "svhn": "classification",
     }
 
-    if args.local_rank == -1 or args.no_cuda:
+    if args.local_rank == -1 and "LOCAL_RANK" in os.environ:
+        # launched by torchrun
+        args.local_rank = int(os.environ["LOCAL_RANK"])
+    cores = None
+    if args.local_rank == -1:
         device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
         n_gpu = torch.cuda.device_count()
+    elif args.no_cuda:
+        # CPU data parallel: one process per NUMA node (or group of cores), pinned to its cores
+        device = torch.device("cpu")
+        n_gpu = 0
+        torch.distributed.init_process_group(backend='gloo')
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", torch.distributed.get_world_size()))
+        cores = core_groups(local_world_size)[args.local_rank]
+        pin_to_cores(cores)
     else:
         torch.cuda.set_device(args.local_rank)
         device = torch.device("cuda", args.local_rank)
@@ -692,11 +885,21 @@ def main():
 
     logger.info("device: {} n_gpu: {}, distributed training: {}, 16-bits training: {}".format(
         device, n_gpu, bool(args.local_rank != -1), args.fp16))
+    if cores is not None:
+        logger.info("rank {} of {}: {} threads on cores {}".format(
+            torch.distributed.get_rank(), torch.distributed.get_world_size(), len(cores), cores))
+    # rank 0 alone writes TensorBoard, checkpoints and results
+    is_main = args.local_rank == -1 or torch.distributed.get_rank() == 0
+    world_size = torch.distributed.get_world_size() if args.local_rank != -1 else 1
 
     if args.gradient_accumulation_steps < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
             args.gradient_accumulation_steps))
 
+    if args.auto_micro_batch and args.memory_budget_mb <= 0:
+        raise ValueError("--auto_micro_batch needs a positive --memory_budget_mb")
+
+    effective_batch_size = args.train_batch_size
     args.train_batch_size = args.train_batch_size // args.gradient_accumulation_steps
 
     random.seed(args.seed)
@@ -718,114 +921,114 @@ def main():
     if task_name not in processors:
         raise ValueError("Task not found: %s" % task_name)
 
-    processor = processors[task_name]()
+    if issubclass(processors[task_name], ImageDataProcessor):
+        processor = processors[task_name](imbalance_ratio=args.imbalance_ratio, seed=args.imbalance_seed)
+    else:
+        processor = processors[task_name]()
     output_mode = output_modes[task_name]
 
     label_list = processor.get_labels()
     num_labels = len(label_list)
     word_emb_mat = None
+    word2idx_dict = None
     args.BERT = True if args.model_name.split("-")[0] == "bert" else False
     args.CIFAR = True if args.task_name.split("-")[0] == "cifar" else False
     args.MNIST = True if args.task_name == "mnist" else False
 
-    summary = SummaryWriter(log_dir=args.tb_log_dir)  # default 'log_dir' is "runs"
+    summary = SummaryWriter(log_dir=args.tb_log_dir) if is_main else None  # default 'log_dir' is "runs"
+    feature_store = FeatureCacheStore(
+        args.feature_cache_dir or os.path.join(args.data_dir, 'feature_cache'),
+        budget_bytes=int(args.feature_cache_budget_gb * 2 ** 30) if args.feature_cache_budget_gb > 0 else None)
 
     if args.do_train:
         # Prepare tokenizer
         tokenizer = tokenizer_loader(args, device, num_labels=num_labels)
 
-        features_by_label = ""
+        train_table = None
 
         if args.model_name in ["rnn"]:
             word2idx_dict, word_emb_mat = word_embeddings(args, processor, tokenizer, word_emb_mat)
 
         if args.do_sampling is True:  # for num_train_optimization step
-            train_steps_per_ep = math.ceil(
-                (args.negative_size + args.positive_size) / args.train_batch_size)  # ceiling
+            train_steps_per_ep = math.ceil(math.ceil(
+                (args.negative_size + args.positive_size) / world_size) / args.train_batch_size)  # ceiling
             train_examples = processor.get_train_examples(args.data_dir)
             if args.BERT:
-                train_features, features_by_label = convert_examples_to_features(
-                    train_examples, label_list, args.max_seq_length, tokenizer, output_mode, sep=True)
+                train_table = convert_examples_to_features(
+                    train_examples, label_list, args.max_seq_length, tokenizer, output_mode, sep=True,
+                    num_workers=args.preprocess_workers)
             elif args.task_name in ["cifar-10", "mnist", "svhn"]:
-                train_vectors, train_labels = train_examples  # (vector, label)
-                train_features, features_by_label = divide_features_by_label(train_vectors, train_labels)
+                train_vectors, train_labels = train_examples  # (uint8 images, labels)
+                train_table = divide_features_by_label(train_vectors, train_labels)
             else:
-                train_features, features_by_label = convert_examples_to_features_rnn(word2idx_dict,
-                    train_examples, label_list, args.max_seq_length, tokenizer, output_mode, sep=True)
+                train_table = convert_examples_to_features_rnn(word2idx_dict,
+                    train_examples, label_list, args.max_seq_length, tokenizer, output_mode, sep=True,
+                    num_workers=args.preprocess_workers)
 
             num_train_examples = args.negative_size + args.positive_size
+        elif args.streaming:
+            train_dataloader = get_streaming_dataloader(args, processor, "train", label_list, tokenizer, output_mode)
+            num_train_examples = train_dataloader.dataset.examples_per_rank
+            train_steps_per_ep = len(train_dataloader)
         else:
-            if os.path.exists(os.path.join(args.data_dir, 'train-%s.pt' % args.model_name)):
-                train_data = torch.load(os.path.join(args.data_dir, 'train-%s.pt' % args.model_name))
-                logger.info("load %s" % os.path.join(args.data_dir, 'train-%s.pt' % args.model_name))
-            else:
-                if args.BERT:
-                    train_examples = processor.get_train_examples(args.data_dir)
-                    train_features, features_by_label = convert_examples_to_features(
-                        train_examples, label_list, args.max_seq_length, tokenizer, output_mode, sep=True)
-                    train_data, _ = get_tensor_dataset(args, train_features, output_mode)
-                    torch.save(train_data, os.path.join(args.data_dir, 'train-%s.pt' % args.model_name))
-                    # torch.save(all_label_ids, os.path.join(args.data_dir, 'train_labels.pt'))
-                    logger.info("train data tensors saved !")
-                elif args.task_name in ["cifar-10", "mnist", "svhn"]:
-                    if args.task_name == 'svhn':
-                        processor.adjust_dataset()
-                    train_features, labels = processor.get_train_examples(args.data_dir)  # (vector, label)
-                    train_data = TensorDataset(
-                        torch.tensor(train_features, dtype=torch.float), torch.tensor(labels, dtype=torch.long))
-                    if args.task_name == "svhn":
-                        torch.save(train_data, os.path.join(args.data_dir, 'train-%s.pt' % args.model_name))
-                        logger.info("train data tensors saved !")
-                else:
-                    train_examples = processor.get_train_examples(args.data_dir)
-                    train_features, features_by_label = convert_examples_to_features_rnn(
-                        word2idx_dict, train_examples, label_list, args.max_seq_length, tokenizer, output_mode, sep=True)
-                    train_data, _ = get_tensor_dataset(args, train_features, output_mode)
-                    torch.save(train_data, os.path.join(args.data_dir, 'train-%s.pt' % args.model_name))
-                    # torch.save(all_label_ids, os.path.join(args.data_dir, 'train_labels.pt'))
-                    logger.info("train data tensors saved !")
+            train_data, _ = load_dataset(args, feature_store, processor, "train", label_list, tokenizer,
+                                         output_mode, word2idx_dict)
 
             num_train_examples = len(train_data)
-            if args.local_rank == -1:
-                _train_sampler = RandomSampler(train_data)
-            else:
-                _train_sampler = DistributedSampler(train_data)
-            train_dataloader = DataLoader(train_data, sampler=_train_sampler, batch_size=args.train_batch_size)
+            train_dataloader = get_train_dataloader(args, train_data)
             train_steps_per_ep = len(train_dataloader)
 
         # Prepare data for devset
-        if os.path.exists(os.path.join(args.data_dir, 'dev-%s.pt' % args.model_name)):
-            dev_data = torch.load(os.path.join(args.data_dir, 'dev-%s.pt' % args.model_name))
-            all_dev_label_ids = torch.load(os.path.join(args.data_dir, 'dev_labels.pt'))
-            logger.info("load %s" % os.path.join(args.data_dir, 'dev-%s.pt' % args.model_name))
+        if task_name in ['wikiqa', 'semeval', 'ubuntu']:
+            # the official eval scripts and ranking metrics need the examples (guids) even when the features are cached
+            dev_examples = processor.get_dev_examples(args.data_dir)
         else:
-            if args.BERT:
-                dev_examples = processor.get_dev_examples(args.data_dir)
-                dev_features = convert_examples_to_features(
-                    dev_examples, label_list, args.max_seq_length, tokenizer, output_mode)
-                dev_data, all_dev_label_ids = get_tensor_dataset(args, dev_features, output_mode)
-            elif args.task_name in ["cifar-10", "mnist", "svhn"]:
-                dev_data, dev_labels = processor.get_dev_examples(args.data_dir)
-                all_dev_label_ids = torch.tensor(dev_labels, dtype=torch.long)
-                dev_data = TensorDataset(torch.tensor(dev_data, dtype=torch.float), all_dev_label_ids)
-            else:
-                dev_examples = processor.get_dev_examples(args.data_dir)
-                dev_features = convert_examples_to_features_rnn(
-                    word2idx_dict, dev_examples, label_list, args.max_seq_length, tokenizer, output_mode)
-                dev_data, all_dev_label_ids = get_tensor_dataset(args, dev_features, output_mode)
-            torch.save(dev_data, os.path.join(args.data_dir, 'dev-%s.pt' % args.model_name))
-            torch.save(all_dev_label_ids, os.path.join(args.data_dir, 'dev_labels.pt'))
-            logger.info("dev data tensors saved !")
-
-        num_train_optimization_steps = train_steps_per_ep // args.gradient_accumulation_steps * args.num_train_epochs
-        if args.local_rank != -1:
-            num_train_optimization_steps = num_train_optimization_steps // torch.distributed.get_world_size()
+            dev_examples = None
+        dev_data, all_dev_label_ids = load_dataset(args, feature_store, processor, "dev", label_list, tokenizer,
+                                                   output_mode, word2idx_dict, examples=dev_examples)
 
         model = model_loader(args, device, num_labels=num_labels, embeddings=word_emb_mat)
         model.to(device)
         if n_gpu > 1:
             model = torch.nn.DataParallel(model)
 
+        if args.auto_micro_batch:
+            if train_table is not None:
+                probe_data = train_table.dataset()
+            elif args.streaming:
+                # the streaming dataset yields whole batches of --train_batch_size, the probe needs examples
+                probe_data = train_dataloader.dataset.head(effective_batch_size)
+            else:
+                probe_data = train_dataloader.dataset
+            args.train_batch_size = auto_micro_batch_size(args, model, probe_data, processor, num_labels, device,
+                                                          effective_batch_size)
+            if args.local_rank != -1:
+                # every rank has to run the same number of steps
+                size = torch.tensor([args.train_batch_size], device=device)
+                torch.distributed.all_reduce(size, op=torch.distributed.ReduceOp.MIN)
+                args.train_batch_size = int(size)
+            args.gradient_accumulation_steps = effective_batch_size // args.train_batch_size
+            if args.do_sampling is True:
+                train_steps_per_ep = math.ceil(math.ceil(
+                    (args.negative_size + args.positive_size) / world_size) / args.train_batch_size)
+            else:
+                if args.streaming:
+                    train_dataloader = get_streaming_dataloader(args, processor, "train", label_list, tokenizer,
+                                                                output_mode)
+                else:
+                    train_dataloader = get_train_dataloader(args, train_data)
+                train_steps_per_ep = len(train_dataloader)
+
+        # the model without the DistributedDataParallel wrapper, for what a single rank computes on its own
+        eval_model = model
+        if args.local_rank != -1:
+            model = DistributedDataParallel(model, device_ids=[args.local_rank] if device.type == "cuda" else None)
+
+        # the last optimizer step of an epoch takes the remaining (< gradient_accumulation_steps) micro-batches;
+        # train_steps_per_ep counts the micro-batches of this process
+        num_train_optimization_steps = (math.ceil(train_steps_per_ep / args.gradient_accumulation_steps)
+                                        * int(args.num_train_epochs))
+
         # Prepare optimizer
 
         param_optimizer = list(model.named_parameters())
@@ -837,56 +1040,150 @@ def main():
 
         # loss weight
         _lambda = torch.nn.Parameter(torch.tensor([0.0001], dtype=torch.float).to(device))
+        lambda_param = _lambda  # `_lambda` is rebound to clamped copies during training
 
         optimizer_grouped_parameters[1]['params'].append(_lambda)
         optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate)
+        scheduler = None
+        if args.lr_schedule == 'linear':
+            scheduler = get_linear_schedule_with_warmup(
+                optimizer, num_warmup_steps=int(args.warmup_proportion * num_train_optimization_steps),
+                num_training_steps=num_train_optimization_steps)
         # optimizer_grouped_parameters2 = [
         #     {'params': [p for n, p in param_optimizer if n in ["classifier.weight", "classifier.bias"]],
         #      'weight_decay': 0.01}
         # ]
         # optimizer2 = AdamW(optimizer_grouped_parameters2, lr=args.learning_rate)
 
-        global_step = 0
+        global_step = 0  # micro-batches
+        optimizer_steps = 0
         tr_loss = 0
 
         logger.info("***** Running training *****")
         logger.info("  Num examples = %d", num_train_examples)
-        logger.info("  Batch size = %d", args.train_batch_size)
+        logger.info("  Batch size = %d (%d x %d accumulated micro-batches)", args.train_batch_size *
+                    args.gradient_accumulation_steps, args.train_batch_size, args.gradient_accumulation_steps)
         logger.info("  Num steps = %d", num_train_optimization_steps)
 
         dev_results = []
+        dev_checkpoints = []
+        early_stopping = EarlyStopping(args.early_stopping_patience, args.min_delta)
+        padding_stats = PaddingStats()
+        scalar_writer = ScalarWriterThread(summary) if is_main else None
+        checkpoint_writer = CheckpointWriter(args.output_dir, keep_best=args.keep_best_checkpoints,
+                                             fp16=args.checkpoint_fp16)
+        metrics = TrainingMetrics(num_labels, device, writer=scalar_writer, flush_every=args.metrics_flush_steps)
         var_results = []
         mean_results = []
-        for ep in range(1, int(args.num_train_epochs) + 1):
+        loss_fct = CrossEntropyLoss(reduction='none')
+        prob_fct = Softmax(dim=1)
+        regularizer = None
+        if args.KLD_rg is True or args.mu_rg is True:
+            regularizer = ClassDistributionRegularizer(
+                num_labels, kld=args.KLD_rg, mu=args.mu_rg, lambda_kld=args.lambda_kld, lambda_mu=args.lambda_mu,
+                decay=args.lambda_decay, decay_rate=args.lambda_decay_rate,
+                step_size=args.lambda_decay_step_size, step_drop=args.lambda_decay_step_drop)
+        start_epoch = 1
+        training_state_file = os.path.join(args.output_dir, TRAINING_STATE_NAME)
+        if args.resume and os.path.exists(training_state_file):
+            state = torch.load(training_state_file, map_location='cpu', weights_only=False)
+            model_to_load = model.module if hasattr(model, 'module') else model
+            model_to_load.load_state_dict(state['model'])
+            optimizer.load_state_dict(state['optimizer'])
+            if scheduler is not None:
+                scheduler.load_state_dict(state['scheduler'])
+            with torch.no_grad():
+                lambda_param.copy_(state['lambda'])
+            if train_table is not None:
+                train_table.weight[:] = state['train_table']['weight']
+                train_table.preprob[:] = state['train_table']['preprob']
+            global_step = state['global_step']
+            optimizer_steps = state['optimizer_steps']
+            metrics.loss_total = state['loss_total']
+            dev_results, mean_results, var_results = state['dev_results'], state['mean_results'], state['var_results']
+            dev_checkpoints = state['dev_checkpoints']
+            early_stopping.load_state_dict(state['early_stopping'])
+            checkpoint_writer.checkpoints = state['checkpoints']
+            set_rng_state(state['rng'])
+            start_epoch = state['epoch'] + 1
+            logger.info("  Resumed from %s: epoch %d, global step %d, optimizer step %d", training_state_file,
+                        state['epoch'], global_step, optimizer_steps)
+            del state
+
+        def evaluate_and_checkpoint(ep, tb_step, name):
+            """Dev eval and `<name>_<score>.bin` checkpoint on rank 0; True when early stopping ends training."""
+            metrics.flush()
+            if is_main:
+                score = evaluate_dev(args, ep, eval_model, device, processor, dev_data, dev_examples,
+                                     all_dev_label_ids, num_labels, output_mode, summary, tb_step,
+                                     metrics.loss_total / global_step)
+                dev_results.append(score)
+                summary.add_scalar('dev_score', score, tb_step)
+                model_to_save = model.module if hasattr(model, 'module') else model  # Only save the model it-self
+                file_name = '%s_%.4f.bin' % (name, score)
+                checkpoint_writer.save(model_to_save.state_dict(), file_name, score)
+                dev_checkpoints.append(file_name)
+                if early_stopping.update(score):
+                    logger.info(" [epoch %d] early stopping: no dev improvement > %s in the last %d evaluations "
+                                "(best %.4f)" % (ep, args.min_delta, args.early_stopping_patience,
+                                                 early_stopping.best))
+            if args.local_rank != -1:
+                # all ranks stop together
+                stopped = [early_stopping.stopped]
+                torch.distributed.broadcast_object_list(stopped, src=0)
+                early_stopping.stopped = stopped[0]
+            return early_stopping.stopped
+
+        last_epoch = int(args.num_train_epochs)
+        rss_before = peak_rss_mb()
+        logger.info("  Peak RSS before training = %.1f MB (lean step: %s)", rss_before, args.lean_step)
+        for ep in range(start_epoch, last_epoch + 1):
+            if early_stopping.stopped:
+                break
             model.train()
             nb_tr_examples = 0
 
             if args.do_sampling is True:
                 logger.info(" [epoch %d] (sampling) get new dataloader ... " % ep)
-                train_dataloader = get_sampling_dataloader(ep, args, features_by_label, BERT)
+                train_dataloader = get_sampling_dataloader(ep, args, train_table)
+            elif args.streaming:
+                train_dataloader.dataset.set_epoch(ep)
+            if isinstance(train_dataloader.sampler, DistributedSampler):
+                train_dataloader.sampler.set_epoch(ep)
+            elif isinstance(train_dataloader.batch_sampler, BucketBatchSampler):
+                train_dataloader.batch_sampler.set_epoch(ep)
 
             logger.info(" [epoch %d] trainig iteration starts ... *****" % ep)
-            t_prob = []
-            c_prob = [[] for _ in range(num_labels)]
-            d_prob = [[] for _ in range(num_labels)]
-            for step, batch in enumerate(train_dataloader):
-                batch = tuple(t.to(device) for t in batch)
-
+            padding_stats.reset()
+            metrics.reset()
+            num_micro_batches = len(train_dataloader)
+            epoch_start = time.time()
+            accumulation = args.gradient_accumulation_steps
+            pending = 0  # micro-batches whose gradients are not stepped yet
+            for step, batch in enumerate(prefetch_to_device(train_dataloader, device)):
                 if args.BERT:
-                    input_ids, input_mask, segment_ids, label_ids, preprob = batch
-                    # define a new function to compute loss values for both output_modes
-                    outputs = model(input_ids, segment_ids, input_mask, labels=None)
-                    logits = outputs[0]  # if labels is None, outputs[0] is logits
-                elif args.task_name in ["cifar-10", "mnist", "svhn"]:
-                    inputs, label_ids = batch
-                    logits = model(inputs)
+                    padding_stats.update(batch[1])
+
+                # the gradient of an optimizer step is the mean over its micro-batches; the last group of the
+                # epoch may be smaller, and past the loader's len() (if it yields more) groups are full-size
+                group_start = step - step % accumulation
+                remaining = num_micro_batches - group_start
+                group_size = min(accumulation, remaining) if remaining > 0 else accumulation
+                # DDP all-reduces the gradients only at the end of a group (or of the batches len() promised);
+                # whether the backward pass syncs is decided in the forward pass
+                sync = step + 1 == group_start + group_size or step + 1 >= num_micro_batches
+                if sync or not isinstance(model, DistributedDataParallel):
+                    ddp_sync = contextlib.nullcontext()
                 else:
-                    input_ids_a, input_ids_b, label_ids, preprob = batch
-                    logits = model(input_ids_a, input_ids_b)
-                loss_fct = CrossEntropyLoss(reduction='none')
-                _loss = loss_fct(logits.view(-1, num_labels), label_ids.view(-1))
-                loss1 = _loss.mean()  # default = 'mean'
-                summary.add_scalar('training_loss', loss1.item(), global_step)
+                    ddp_sync = model.no_sync()
+
+                # define a new function to compute loss values for both output_modes
+                with ddp_sync, autocast(args, device):
+                    logits, label_ids = batch_logits(args, model, batch, processor)
+                    _loss = loss_fct(logits.view(-1, num_labels), label_ids.view(-1))
+                    loss1 = _loss.mean()  # default = 'mean'
+                logits = logits.float()
+                metrics.log_step('training_loss', loss1, global_step)
 
                 # label_mask = (label_ids == 1)  # major class == 0
                 # major_probs = Softmax(dim=1)(logits[label_mask])[:, 1]
@@ -895,239 +1192,153 @@ def main():
                 loss = loss1
 
                 if args.debug is True or args.KLD_rg is True or args.mu_rg is True:
-                    # major_t_prob.extend(major_probs.tolist())
-                    # minor_t_prob.extend(minor_probs.tolist())
                     # probs = Softmax(dim=1)(logits)[:, 1]
-                    probs = Softmax(dim=1)(logits)
-                    t_prob.extend(probs.view(-1).tolist())
-                    for k in range(num_labels):
-                        d_prob[k].extend(probs[:, k].tolist())
-                        _mask = (label_ids == k)
-                        if _mask.size(0) > 0:
-                            _probs = Softmax(dim=1)(logits[_mask])[:, k]
-                            c_prob[k].extend(_probs.tolist())
+                    probs = prob_fct(logits)
+                    metrics.add_probs(probs, label_ids)
 
                 if n_gpu > 1:
                     loss = loss.mean()  # mean() to average on multi-gpu.
-                if args.gradient_accumulation_steps > 1:
-                    loss = loss / args.gradient_accumulation_steps
 
-                tr_loss += loss.item()
+                metrics.add_loss(loss)
                 nb_tr_examples += label_ids.size(0)
                 global_step += 1
                 # if global_step % 2000:
                 #     logger.info("   loss = %.8f" % loss)
 
                 # experiment: minimize the difference between two classes
-                min_probs = []
-                max_probs = []
-                mu_sum = 0
-                if args.KLD_rg is True or args.mu_rg is True:
-                    temp = []
-                    for k in range(num_labels):
-                        temp.append(probs[:, k].var())
-                        if args.mu_rg is True:
-                            mu_sum += abs(1 / num_labels - probs[:, k].mean())
-                    if args.KLD_rg is True:
-                        _max_var_idx = np.array(temp).argmax()
-                        _min_var_idx = np.array(temp).argmin()
-                        max_probs = probs[:, _max_var_idx]
-                        min_probs = probs[:, _min_var_idx]
-                if args.KLD_rg is True:  # exclude the case only negatives in mini-batch.
-                    _lambda_var = 0.001
-                    # TODO compare KLD value with baseline and regularized model.
-                    # _lambda_var = 0
-                    if args.lambda_decay == 'none':
-                        _decay = 1
-                    elif args.lambda_decay == 'exp':
-                        _k = 0.01
-                        _decay = math.exp(-_k * ep)  # decay = lambda * exp(-kt)
-                    elif args.lambda_decay == 'step':
-                        step_size = 20
-                        _decay = (1 - 0.1 * math.floor(ep/step_size))
-                    KLD1 = KL_loss(min_probs, max_probs)
-                    KLD2 = KL_loss(max_probs, min_probs)
-                    kld = 0.5 * (KLD1 + KLD2)
-                    summary.add_scalar('KLD', kld, global_step)
-                    if kld < 20:
-                        loss = loss + _lambda_var * _decay * kld
-                if args.mu_rg is True:
-                    _lambda_mu = 0.0001
-                    if args.lambda_decay == 'none':
-                        _decay = 1
-                    elif args.lambda_decay == 'exp':
-                        _k = 0.01
-                        _decay = math.exp(-_k * ep)  # decay = lambda * exp(-kt)
-                    elif args.lambda_decay == 'step':
-                        step_size = 20
-                        _decay = (1 - 0.1 * math.floor(ep/step_size))
-                    mu = mu_sum / num_labels
-                    summary.add_scalar('mu', mu, global_step)
-                    loss = loss + _lambda_mu * _decay * mu
-
-                loss.backward(retain_graph=True)
-                optimizer.step()
-                optimizer.zero_grad()
-                _lambda = torch.clamp(_lambda, min=0.00001, max=0.001)
+                if regularizer is not None:
+                    penalty, kld, mu = regularizer(probs, ep)
+                    if kld is not None:
+                        metrics.log_step('KLD', kld, global_step)
+                    if mu is not None:
+                        metrics.log_step('mu', mu, global_step)
+                    loss = loss + penalty
+
+                (loss / group_size).backward(retain_graph=not args.lean_step)
+                pending += 1
+                if step + 1 == group_start + group_size:
+                    optimizer.step()
+                    if scheduler is not None:
+                        scheduler.step()
+                    optimizer.zero_grad(set_to_none=args.lean_step)
+                    _lambda = torch.clamp(_lambda, min=0.00001, max=0.001)
+                    pending = 0
+                    optimizer_steps += 1
+                metrics.step(global_step)
+                # evaluate (and checkpoint) only right after an optimizer step, never on half a group
+                if pending == 0 and args.eval_every_steps > 0 and optimizer_steps % args.eval_every_steps == 0:
+                    stopped = evaluate_and_checkpoint(ep, optimizer_steps,
+                                                      'pytorch_model_%d_step%d' % (ep, optimizer_steps))
+                    model.train()
+                    if stopped:
+                        break
 
             # end of epoch
+            if pending > 0 and not early_stopping.stopped:
+                # an incomplete group (the loader yielded fewer or more batches than len() promised) is stepped
+                # with the mean over its own micro-batches rather than leaking into the next epoch
+                for group in optimizer.param_groups:
+                    for p in group['params']:
+                        if p.grad is not None:
+                            p.grad.mul_(group_size / pending)
+                optimizer.step()
+                if scheduler is not None:
+                    scheduler.step()
+                optimizer.zero_grad(set_to_none=args.lean_step)
+                optimizer_steps += 1
+            metrics.flush()
+            tr_loss = metrics.loss_total
+            epoch_time = time.time() - epoch_start
+            logger.info(" [epoch %d] %d examples in %.1fs: %.1f examples/s (%s)" % (
+                ep, nb_tr_examples, epoch_time, nb_tr_examples / epoch_time, args.precision))
+            if is_main:
+                summary.add_scalar('train_examples_per_sec', nb_tr_examples / epoch_time, ep)
+            if args.local_rank != -1:
+                report_scaling(args, ep, nb_tr_examples, epoch_time, device, summary)
+            rss = peak_rss_mb()
+            logger.info(" [epoch %d] peak RSS: %.1f MB (+%.1f MB during training)" % (ep, rss, rss - rss_before))
+            if device.type == "cuda":
+                logger.info(" [epoch %d] peak CUDA memory: %.1f MB" % (
+                    ep, torch.cuda.max_memory_allocated(device) / 2 ** 20))
+            if args.BERT:
+                logger.info(" [epoch %d] padding efficiency (real / computed tokens): %.4f" % (
+                    ep, padding_stats.efficiency()))
+                if is_main:
+                    summary.add_scalar('padding_efficiency', padding_stats.efficiency(), ep)
             if args.KLD_rg is True:
-                logger.info("KL Divergence Regularization applied with %s | decay: %s" % (str(_lambda_var), args.lambda_decay))
+                logger.info("KL Divergence Regularization applied with %s | decay: %s" % (
+                    str(regularizer.lambda_kld), args.lambda_decay))
             if args.mu_rg is True:
-                logger.info("Mean Divergence Regularization applied with %s | decay: %s" % (str(_lambda_mu), args.lambda_decay))
+                logger.info("Mean Divergence Regularization applied with %s | decay: %s" % (
+                    str(regularizer.lambda_mu), args.lambda_decay))
             if args.debug is True:
-                pass
-                # logger.info("prob mean: %.6f, var: %.6f" %
-                #             (torch.tensor(t_prob).mean().item(),
-                #              torch.tensor(t_prob).var().item()))
-                # logger.info("     weight: %0.6f" % model.layer_norm.weight[0])
-                # logger.info("       bias: %0.6f" % model.layer_norm.bias[0])
-                # for t in model.named_parameters():
-                #     name, param = t
-                #     logger.info("%20s, mean: %0.6f, var: %0.6f" % (name, param.mean(), param.var()))
-                # sampling_ploting(t_prob, ep)
-                # output_ploting(label0_t_prob, label1_t_prob, ep)
-                # mean_results.append(torch.tensor(t_prob).mean().item())
-                # var_results.append(torch.tensor(t_prob).var().item())
-                # for k in range(num_labels):
-                #     logger.info("[class %d (y=true)] %d mean: %.4f, var: %.4f" % (
-                #         k, len(c_prob[k]), torch.tensor(c_prob[k]).mean().item(), torch.tensor(c_prob[k]).var().item()))
-                # for k in range(num_labels):
-                #     logger.info("[class %d (total )] %d mean: %.4f, var: %.4f" % (
-                #         k, len(d_prob[k]), torch.tensor(d_prob[k]).mean().item(), torch.tensor(d_prob[k]).var().item()))
+                prob_mean, prob_var = metrics.prob_moments()
+                logger.info("prob mean: %.6f, var: %.6f" % (prob_mean, prob_var))
+                mean_results.append(prob_mean)
+                var_results.append(prob_var)
+                moments = metrics.class_moments()
+                for name in ["y=true", "total"]:
+                    means, variances, counts = moments[name]
+                    for k in range(num_labels):
+                        logger.info("[class %d (%-6s)] %d mean: %.4f, var: %.4f" % (
+                            k, name, counts[k], means[k], variances[k]))
 
             ##########################################################################
             # update weight in sampling experiments
-            if args.do_sampling is True and args.sampling_method not in ['random']:
+            if args.do_sampling is True and args.sampling_method not in ['random'] and not early_stopping.stopped:
                 logger.info(" [epoch %d] update pre probs ... " % ep)
-                train_features, features_by_label = update_probs(ep, train_features, model, device, args, BERT, CIFAR)
+                update_probs(ep, train_table, eval_model, device, args, processor)
             ##########################################################################
             # eval with dev set.
-            dev_sampler = SequentialSampler(dev_data)
-            # dev_sampler = RandomSampler(dev_data, replacement=False)
-            if task_name == 'wikiqa':
-                dev_dataloader = DataLoader(dev_data, sampler=dev_sampler, batch_size=1)
-                score, log = wikiqa_eval(ep, device, dev_examples, dev_dataloader, model, logger, BERT)
-                score = round(score, 4)
-                dev_results.append(score)
-            elif task_name == 'semeval':
-                dev_dataloader = DataLoader(dev_data, sampler=dev_sampler, batch_size=1)
-                score = semeval_eval(ep, device, dev_examples, dev_dataloader, model, logger, BERT, _type="dev")
-                score = round(score, 4)
-            else:
-                dev_dataloader = DataLoader(dev_data, sampler=dev_sampler, batch_size=args.eval_batch_size)
-
-                model.eval()
-                dev_loss = 0
-                nb_dev_steps = 0
-                preds = []
-
-                true_dist = np.zeros(10)
-                pred_dist = np.zeros(10)
-                logger.info(" [epoch %d] devset evaluating ... " % ep)
-                for idx, batch in enumerate(dev_dataloader):
-                    batch = tuple(t.to(device) for t in batch)
-                    with torch.no_grad():
-                        if args.BERT:
-                            input_ids, input_mask, segment_ids, label_ids, preprob = batch
-                            logits, _, _ = model(input_ids, segment_ids, input_mask, labels=None)
-                        elif args.task_name in ["cifar-10", "mnist", "svhn"]:
-                            inputs, label_ids = batch
-                            logits = model(inputs)
-                        else:
-                            input_ids_a, input_ids_b, label_ids, preprob = batch
-                            logits = model(input_ids_a, input_ids_b)
-
-                    # create eval loss and other metric required by the task
-                    if output_mode == "classification":
-                        loss_fct = CrossEntropyLoss()
-                        tmp_eval_loss = loss_fct(logits.view(-1, num_labels), label_ids.view(-1))
-                    elif output_mode == "regression":
-                        loss_fct = MSELoss()
-                        tmp_eval_loss = loss_fct(logits.view(-1), label_ids.view(-1))
-                    dev_loss += tmp_eval_loss.mean().item()
-                    nb_dev_steps += 1
-                    _probs = Softmax(dim=1)(logits)
-                    if len(preds) == 0:
-                        preds.append(logits.detach().cpu().numpy())
-                        probs = _probs.tolist()
-                    else:
-                        preds[0] = np.append(preds[0], logits.detach().cpu().numpy(), axis=0)
-                        probs.extend(_probs.tolist())
-                    # for j in label_ids:
-                    #     true_dist[j] += 1
-                    # pred_dist += _probs.sum(dim=0).tolist()
-                        # summary.add_histogram('output_distributions', _probs.mean(dim=0), global_step=ep)
-
-                # true_dist = true_dist / np.sum(true_dist)
-                # pred_dist = pred_dist / len(dev_data)
-                # summary.add_figure('output_distributions',
-                #                    # plot_vector_bar(true_dist, _probs.mean(dim=0).tolist(), processor.get_class_name()),
-                #                    plot_vector_bar(true_dist, pred_dist, processor.get_class_name()),
-                #                    global_step=ep)
-                # if ep == 37:
-                #     summary.add_figure('output_distributions',
-                #                        # plot_vector_bar(true_dist, _probs.mean(dim=0).tolist(), processor.get_class_name()),
-                #                        plot_vector_bar(true_dist, pred_dist, processor.get_class_name()),
-                #                        global_step=ep)
-                dev_loss = dev_loss / nb_dev_steps
-                preds = preds[0]
-                if output_mode == "classification":
-                    preds = np.argmax(preds, axis=1)
-                elif output_mode == "regression":
-                    preds = np.squeeze(preds)
-                result = compute_metrics(task_name, preds, all_dev_label_ids.numpy(), probs=probs)
-                loss = tr_loss / global_step if args.do_train else None
-
-                result['dev_loss'] = dev_loss
-                result['loss'] = loss
-                logger.info(" [epoch %d] devset eval results " % ep)
-                for key in sorted(result.keys()):
-                    logger.info("  %s = %s", key, str(result[key]))
-
-                if task_name == "squad":
-                    score = round(result['f1'], 4)
-                    dev_results.append(score)
-                elif task_name in ["quac", "dstc", 'ubuntu', 'selqa', 'cifar-10-bin']:
-                    score = round(result['f1'][1], 4)
-                    dev_results.append(score)
-                elif task_name in ["cifar-10", "mnist"]:
-                    score = round(result['acc'], 4)
-                    dev_results.append(score)
-                    major_f1 = result['f1'][0]
-                    minor_f1 = np.array(result['f1'][1:]).mean()
-                    macro_f1 = np.array(result['f1']).mean()
-                    logger.info("  macro f1       = %.4f (macro avg of f1)", macro_f1)
-                    logger.info("  major f1       = %.4f", major_f1)
-                    logger.info("  minor f1 (avg) = %.4f", minor_f1)
-                    summary.add_scalar('major_f1', major_f1, ep)
-                    summary.add_scalar('minor_f1', minor_f1, ep)
-                else:
-                    score = round(result['acc'], 4)
-                    dev_results.append(score)
-            summary.add_scalar('dev_score', score, ep)
-            model_to_save = model.module if hasattr(model, 'module') else model  # Only save the model it-self
-            output_model_file = os.path.join(args.output_dir, 'pytorch_model_%d_%.4f.bin' % (ep, score))
-            torch.save(model_to_save.state_dict(), output_model_file)
+            if args.eval_every_steps == 0:
+                evaluate_and_checkpoint(ep, ep, 'pytorch_model_%d' % ep)
+            elif ep == last_epoch and optimizer_steps % args.eval_every_steps != 0 and not early_stopping.stopped:
+                # the steps after the last scheduled evaluation
+                evaluate_and_checkpoint(ep, optimizer_steps, 'pytorch_model_%d_step%d' % (ep, optimizer_steps))
+            if args.resume and is_main:
+                model_to_save = model.module if hasattr(model, 'module') else model  # Only save the model it-self
+                # everything the next epoch depends on, taken at the epoch boundary
+                checkpoint_writer.save_state({
+                    'epoch': ep,
+                    'global_step': global_step,
+                    'optimizer_steps': optimizer_steps,
+                    'loss_total': metrics.loss_total,
+                    'model': model_to_save.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'scheduler': scheduler.state_dict() if scheduler is not None else None,
+                    'lambda': lambda_param,
+                    'train_table': ({'weight': train_table.weight, 'preprob': train_table.preprob}
+                                    if train_table is not None else None),
+                    'dev_results': dev_results,
+                    'dev_checkpoints': dev_checkpoints,
+                    'early_stopping': early_stopping.state_dict(),
+                    'mean_results': mean_results,
+                    'var_results': var_results,
+                    'checkpoints': checkpoint_writer.checkpoints,
+                    'rng': rng_state(),
+                }, TRAINING_STATE_NAME)
 
         # end of whole training
-        idx, _max = 0, 0
-        for i, result in enumerate(dev_results):
-            if result > _max:
-                _max = result
-                _idx = i+1
-            print(result)
-        print("max: ep %d, %.4f" % (_idx, _max))
-        max_model_file = ("pytorch_model_%d_%.4f.bin" % (_idx, _max))
-        print("max weight: %s" % max_model_file)
-        print("mean")
-        for result in mean_results:
-            print(result)
-        print("var")
-        for result in var_results:
-            print(result)
-
-    if args.do_train and (args.local_rank == -1 or torch.distributed.get_rank() == 0):
+        checkpoint_writer.close()
+        if is_main:
+            scalar_writer.close()
+            idx, _max = 0, 0
+            for i, result in enumerate(dev_results):
+                if result > _max:
+                    _max = result
+                    _idx = i+1
+                print(result)
+            print("max: eval %d, %.4f" % (_idx, _max))
+            max_model_file = dev_checkpoints[_idx - 1]
+            print("max weight: %s" % max_model_file)
+            print("mean")
+            for result in mean_results:
+                print(result)
+            print("var")
+            for result in var_results:
+                print(result)
+
+    if args.do_train and is_main:
         output_model_file = os.path.join(args.output_dir, WEIGHTS_NAME)
         # output_config_file = os.path.join(args.output_dir, CONFIG_NAME)
 
@@ -1137,9 +1348,9 @@ def main():
             # model_to_save.config.to_json_file(output_config_file)
             tokenizer.save_vocabulary(args.output_dir)
         else:
-            torch.save(model.state_dict(), output_model_file)
+            torch.save(eval_model.state_dict(), output_model_file)
 
-    if args.do_eval or args.do_train_eval:
+    if (args.do_eval or args.do_train_eval) and is_main:
         if args.model_name == 'rnn':
             if os.path.exists(os.path.join(args.data_dir, 'word_emb_mat.json')):
                 with open(args.data_dir + "word_emb_mat.json") as fh:
@@ -1156,90 +1367,37 @@ def main():
         model.to(device)
 
         # test_ids = [e.guid for e in test_examples]
-        if os.path.exists(os.path.join(args.data_dir, 'test-%s.pt' % args.model_name)):
-            test_data = torch.load(os.path.join(args.data_dir, 'test-%s.pt' % args.model_name))
-            all_label_ids = torch.load(os.path.join(args.data_dir, 'test_labels.pt'))
-            logger.info("load %s" % os.path.join(args.data_dir, 'test-%s.pt'))
-            if task_name in ['wikiqa', 'semeval']:
-                test_examples = processor.get_test_examples(args.data_dir)
-        else:
+        if task_name in ['wikiqa', 'semeval']:
             test_examples = processor.get_test_examples(args.data_dir)
-            if args.BERT:
-                test_features = convert_examples_to_features(
-                    test_examples, label_list, args.max_seq_length, tokenizer, output_mode)
-                test_data, all_label_ids = get_tensor_dataset(args, test_features, output_mode)
-            elif args.task_name in ["cifar-10", "mnist", "svhn"]:
-                test_features, test_labels = test_examples
-                all_label_ids = torch.tensor(test_labels, dtype=torch.long)
-                test_data = TensorDataset(
-                    torch.tensor(test_features, dtype=torch.float), all_label_ids)
-            else:
-                test_features = convert_examples_to_features_rnn(
-                    word2idx_dict, test_examples, label_list, args.max_seq_length, tokenizer, output_mode)
-                test_data, all_label_ids = get_tensor_dataset(args, test_features, output_mode)
-            torch.save(test_data, os.path.join(args.data_dir, 'test-%s.pt' % args.model_name))
-            torch.save(all_label_ids, os.path.join(args.data_dir, 'test_labels.pt'))
-            logger.info("Test data tensors saved !")
+        else:
+            test_examples = None
+        test_data, all_label_ids = load_dataset(args, feature_store, processor, "test", label_list, tokenizer,
+                                                output_mode, word2idx_dict, examples=test_examples)
 
         logger.info("***** Running evaluation *****")
         logger.info("  Num examples = %d", len(test_data))
         logger.info("  Batch size = %d", args.eval_batch_size)
 
         # Run prediction for full data
-        eval_sampler = SequentialSampler(test_data)
         if task_name == 'wikiqa':
-            eval_dataloader = DataLoader(test_data, sampler=eval_sampler, batch_size=1)
-            _ = wikiqa_eval(0, device, test_examples, eval_dataloader, model, logger, BERT)
+            eval_dataloader, eval_order = get_eval_dataloader(args, test_data, args.eval_batch_size)
+            with autocast(args, device):
+                _ = wikiqa_eval(0, device, test_examples, eval_dataloader, model, logger, args.BERT,
+                                order=eval_order)
         elif task_name == 'semeval':
-            eval_dataloader = DataLoader(test_data, sampler=eval_sampler, batch_size=1)
-            _ = semeval_eval(0, device, test_examples, eval_dataloader, model, logger, BERT, _type="test")
+            eval_dataloader, eval_order = get_eval_dataloader(args, test_data, args.eval_batch_size)
+            with autocast(args, device):
+                _ = semeval_eval(0, device, test_examples, eval_dataloader, model, logger, args.BERT, _type="test",
+                                 order=eval_order)
         else:
-            eval_dataloader = DataLoader(test_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
-
-            model.eval()
-            eval_loss = 0
-            nb_eval_steps = 0
-            preds = []
-            probs = []
-
-            for batch in tqdm(eval_dataloader, desc="Evaluating"):
-                batch = tuple(t.to(device) for t in batch)
-                with torch.no_grad():
-                    if args.BERT:
-                        input_ids, input_mask, segment_ids, label_ids, preprob = batch
-                        logits, _, _ = model(input_ids, segment_ids, input_mask, labels=None)
-                    elif args.task_name in ["cifar-10", "mnist", "svhn"]:
-                        inputs, label_ids = batch
-                        logits = model(inputs)
-                    else:
-                        input_ids_a, input_ids_b, label_ids, preprob = batch
-                        logits = model(input_ids_a, input_ids_b)
-
-                # create eval loss and other metric required by the task
-                if output_mode == "classification":
-                    loss_fct = CrossEntropyLoss()
-                    tmp_eval_loss = loss_fct(logits.view(-1, num_labels), label_ids.view(-1))
-                elif output_mode == "regression":
-                    loss_fct = MSELoss()
-                    tmp_eval_loss = loss_fct(logits.view(-1), label_ids.view(-1))
-
-                eval_loss += tmp_eval_loss.mean().item()
-                nb_eval_steps += 1
-                if len(preds) == 0:
-                    preds.append(logits.detach().cpu().numpy())
-                    probs = Softmax(dim=1)(logits).tolist()
-                else:
-                    preds[0] = np.append(preds[0], logits.detach().cpu().numpy(), axis=0)
-                    probs.extend(Softmax(dim=1)(logits).tolist())
-
-            eval_loss = eval_loss / nb_eval_steps
-            preds = preds[0]
+            logits, probs, eval_loss = predict(args, model, test_data, device, processor, num_labels, output_mode)
+            preds = logits.numpy()
             if output_mode == "classification":
                 preds = np.argmax(preds, axis=1)
             elif output_mode == "regression":
                 preds = np.squeeze(preds)
             result = compute_metrics(task_name, preds, all_label_ids.numpy(),
-                                     probs=probs)
+                                     probs=probs.numpy())
             loss = tr_loss / global_step if args.do_train else None
 
             result['eval_loss'] = eval_loss
@@ -1286,110 +1444,184 @@ def word_counting(args, counter, processor, tokenizer):
     trains = processor.get_train_examples(args.data_dir)
     devs = processor.get_dev_examples(args.data_dir)
     tests = processor.get_test_examples(args.data_dir)
-    for (ex_index, example) in enumerate(trains + devs + tests):
-        tokens_a = tokenizer.tokenize(example.text_a)
-        tokens_b = tokenizer.tokenize(example.text_b)
+    examples = trains + devs + tests
+    texts = [example.text_a for example in examples] + [example.text_b for example in examples]
+    for tokens in tokenize_texts(tokenizer, texts, n_process=args.preprocess_workers):
+        counter.update(tokens)
+    log_tokenization_stats(tokenizer, logger)
+
+
+class EarlyStopping(object):
+    """Stops after `patience` dev evaluations in a row without beating the best score by more than `min_delta`.
+
+    `patience=0` never stops.
+    """
+
+    def __init__(self, patience=0, min_delta=0.0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = None
+        self.bad_evals = 0
+        self.stopped = False
+
+    def update(self, score):
+        """Records a dev score; returns True when training should stop."""
+        if self.best is None or score > self.best + self.min_delta:
+            self.best = score
+            self.bad_evals = 0
+        else:
+            self.bad_evals += 1
+        self.stopped = self.patience > 0 and self.bad_evals >= self.patience
+        return self.stopped
+
+    def state_dict(self):
+        return {'best': self.best, 'bad_evals': self.bad_evals, 'stopped': self.stopped}
+
+    def load_state_dict(self, state):
+        self.best, self.bad_evals, self.stopped = state['best'], state['bad_evals'], state['stopped']
 
-        for t in (tokens_a + tokens_b):
-            counter[t] += 1
 
+def evaluate_dev(args, ep, model, device, processor, dev_data, dev_examples, all_dev_label_ids,
+                 num_labels, output_mode, summary, tb_step, train_loss):
+    """Evaluates `model` on the dev set and returns the task's dev score (F1, accuracy, ...).
 
-def update_probs(ep, train_features, model, device, args):
+    `tb_step` is the TensorBoard step of the per-class scalars and
+    `train_loss` the average training loss reported with the results.
+    """
+    task_name = args.task_name.lower()
+    if task_name == 'wikiqa':
+        dev_dataloader, dev_order = get_eval_dataloader(args, dev_data, args.eval_batch_size)
+        with autocast(args, device):
+            score, log = wikiqa_eval(ep, device, dev_examples, dev_dataloader, model, logger, args.BERT,
+                                     order=dev_order)
+        score = round(score, 4)
+    elif task_name == 'semeval':
+        dev_dataloader, dev_order = get_eval_dataloader(args, dev_data, args.eval_batch_size)
+        with autocast(args, device):
+            score, log = semeval_eval(ep, device, dev_examples, dev_dataloader, model, logger, args.BERT,
+                                      _type="dev", order=dev_order)
+        score = round(score, 4)
+    else:
+        logger.info(" [epoch %d] devset evaluating ... " % ep)
+        logits, probs, dev_loss = predict(args, model, dev_data, device, processor, num_labels, output_mode)
+        preds = logits.numpy()
+        if output_mode == "classification":
+            preds = np.argmax(preds, axis=1)
+        elif output_mode == "regression":
+            preds = np.squeeze(preds)
+        ids = [e.guid for e in dev_examples] if dev_examples is not None else None
+        result = compute_metrics(task_name, preds, all_dev_label_ids.numpy(), probs=probs.numpy(), ids=ids)
+
+        result['dev_loss'] = dev_loss
+        result['loss'] = train_loss
+        logger.info(" [epoch %d] devset eval results " % ep)
+        for key in sorted(result.keys()):
+            logger.info("  %s = %s", key, str(result[key]))
+
+        if task_name == "squad":
+            score = round(result['f1'], 4)
+        elif task_name in ["quac", "dstc", 'ubuntu', 'selqa', 'cifar-10-bin']:
+            score = round(result['f1'][1], 4)
+        elif task_name in ["cifar-10", "mnist"]:
+            score = round(result['acc'], 4)
+            major_f1 = result['f1'][0]
+            minor_f1 = np.array(result['f1'][1:]).mean()
+            macro_f1 = np.array(result['f1']).mean()
+            logger.info("  macro f1       = %.4f (macro avg of f1)", macro_f1)
+            logger.info("  major f1       = %.4f", major_f1)
+            logger.info("  minor f1 (avg) = %.4f", minor_f1)
+            summary.add_scalar('major_f1', major_f1, tb_step)
+            summary.add_scalar('minor_f1', minor_f1, tb_step)
+        else:
+            score = round(result['acc'], 4)
+    return score
+
+
+def report_scaling(args, ep, nb_examples, epoch_time, device, summary):
+    """Logs the training throughput of all processes together and, with --scaling_baseline, the scaling efficiency."""
+    # on `device`, which NCCL requires to be a GPU
+    examples = torch.tensor([nb_examples], dtype=torch.float64, device=device)
+    torch.distributed.all_reduce(examples)
+    # the epoch takes as long as its slowest process
+    elapsed = torch.tensor([epoch_time], dtype=torch.float64, device=device)
+    torch.distributed.all_reduce(elapsed, op=torch.distributed.ReduceOp.MAX)
+    world_size = torch.distributed.get_world_size()
+    throughput = examples.item() / elapsed.item()
+    logger.info(" [epoch %d] %d processes: %.1f examples/s (%.1f per process)" % (
+        ep, world_size, throughput, throughput / world_size))
+    if args.scaling_baseline > 0:
+        efficiency = throughput / (world_size * args.scaling_baseline)
+        logger.info(" [epoch %d] scaling efficiency from 1 to %d processes: %.3f (speedup %.2fx)" % (
+            ep, world_size, efficiency, throughput / args.scaling_baseline))
+        if summary is not None:
+            summary.add_scalar('scaling_efficiency', efficiency, ep)
+    if summary is not None:
+        summary.add_scalar('total_examples_per_sec', throughput, ep)
+
+
+def update_probs(ep, train_table, model, device, args, processor):
+    """Re-scores every training example and updates the `weight` and `preprob` columns in place."""
     def func(x):
         return 4 * (-(x * x) + x)
 
-    train_data, _ = get_tensor_dataset(args, train_features, "classification")
-    loader = DataLoader(train_data, sampler=SequentialSampler(train_data), batch_size=1024)
-    global_logit_idx = 0
-    for batch in loader:
-        batch = tuple(t.to(device) for t in batch)
+    _, probs, _ = predict(args, model, train_table.dataset(), device, processor, train_table.num_labels,
+                          "classification")
 
-        with torch.no_grad():
-            if args.BERT:
-                input_ids, input_mask, segment_ids, label_ids, preprob = batch
-                # define a new function to compute loss values for both output_modes
-                logits, _, _ = model(input_ids, segment_ids, input_mask, labels=None)
-            elif args.task_name in ["cifar-10", "mnist", "svhn"]:
-                inputs, label_ids = batch
-                logits = model(inputs)
-            else:
-                input_ids_a, input_ids_b, label_ids, preprob = batch
-                logits = model(input_ids_a, input_ids_b)
-
-        probs = Softmax(dim=-1)(logits)
-        batch_size = logits.size(0)
-        for i in range(batch_size):
-            if args.sampling_method == 'weighted':
-                if label_ids[i] == 0:
-                    train_features[global_logit_idx + i].weight = probs[i][1].item()
-                else:  # label_ids[i] == 1
-                    train_features[global_logit_idx + i].weight = probs[i][0].item()
-            elif args.sampling_method == 'border':
-                train_features[global_logit_idx+i].weight = func(probs[i][1].item())
-            elif args.sampling_method == 'tardy' and ep > 1:
-                # TODO tardy sampling
-                cur_prob = probs[i][1].item()
-                pre_prob = train_features[global_logit_idx+i].preprob
-                train_features[global_logit_idx+i].weight = (1 - ((pre_prob-cur_prob)/pre_prob))*cur_prob
-            # update pre-prob
-            train_features[global_logit_idx + i].preprob = probs[i][1].item()
-        global_logit_idx += batch_size
-
-    assert global_logit_idx == len(train_data)
-
-    features_by_label = [[], []]
-    for f in train_features:
-        if f.label_id == 0:
-            features_by_label[0].append(f)
-        else:
-            features_by_label[1].append(f)
-    return train_features, features_by_label
+    assert len(probs) == len(train_table)
+
+    cur_prob = probs[:, 1]
+    if args.sampling_method == 'weighted':
+        train_table.weight[:] = torch.where(train_table.label_ids == 0, probs[:, 1], probs[:, 0])
+    elif args.sampling_method == 'border':
+        train_table.weight[:] = func(cur_prob)
+    elif args.sampling_method == 'tardy' and ep > 1:
+        # TODO tardy sampling
+        pre_prob = train_table.preprob
+        train_table.weight[:] = (1 - ((pre_prob - cur_prob) / pre_prob)) * cur_prob
+    # update pre-prob
+    train_table.preprob[:] = cur_prob
 
 
 def softmax(x):
-    return np.exp(x) / sum(np.exp(x))
+    return np.exp(x) / np.sum(np.exp(x))
 
 
-def get_sampling_dataloader(ep, args, features_by_label):
+def get_sampling_dataloader(ep, args, train_table):
+    label_0_pool, label_1_pool = train_table.by_label[0], train_table.by_label[1]
     if args.sampling_method not in ['random']:
-        # temp = np.array([i.weight for i in features_by_label[0]])
-        # weight0 = temp / np.sum(temp)
-        weight0 = softmax([i.weight for i in features_by_label[0]])
-        weight1 = softmax([i.weight for i in features_by_label[1]])
+        weight0 = softmax(train_table.weight[label_0_pool].numpy())
+        weight1 = softmax(train_table.weight[label_1_pool].numpy())
     # if len(features_by_label[0]) > len(features_by_label[1]):
     if args.sampling_method in ['weighted', 'border'] or (args.sampling_method == 'tardy' and ep > 2):  # weighted sampling
         logger.info(" => %s sampling ..." % args.sampling_method)
-        label_0 = np.random.choice(features_by_label[0], args.negative_size, replace=False, p=weight0)
-        label_1 = np.random.choice(features_by_label[1], args.positive_size, replace=False, p=weight1)
+        label_0 = np.random.choice(label_0_pool, args.negative_size, replace=False, p=weight0)
+        label_1 = np.random.choice(label_1_pool, args.positive_size, replace=False, p=weight1)
     elif args.sampling_method == 'random' or (args.sampling_method == 'tardy' and ep <= 2):  # random sampling
         logger.info(" => Random sampling ...")
-        label_0 = np.random.choice(features_by_label[0], args.negative_size, replace=False)
-        label_1 = np.random.choice(features_by_label[1], args.positive_size, replace=False)
+        label_0 = np.random.choice(label_0_pool, args.negative_size, replace=False)
+        label_1 = np.random.choice(label_1_pool, args.positive_size, replace=False)
     total = np.concatenate((label_0, label_1))
-    train_data, _ = get_tensor_dataset(args, total, "classification")
-    train_sampler = RandomSampler(train_data)
-    train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
-    return train_dataloader
+    return get_train_dataloader(args, train_table.subset(total))
 
 
-def get_gated_sampling_dataloader(device, ep, args, features_by_label, pre_loss=0):
+def get_gated_sampling_dataloader(device, ep, args, train_table, pre_loss=0):
     threshold = 0.5
+    label_0_pool, label_1_pool = train_table.by_label[0], train_table.by_label[1]
     if ep == 1:
-        label_0 = np.random.choice(features_by_label[0], args.positive_size, replace=False)
+        label_0 = np.random.choice(label_0_pool, args.positive_size, replace=False)
         logger.info(" gated-sampling result: th: %.2f, neg: %d, pos: %d" %
-                    (threshold, len(label_0), len(features_by_label[1])))
-        total = np.concatenate((label_0, features_by_label[1]))
+                    (threshold, len(label_0), len(label_1_pool)))
+        total = np.concatenate((label_0, label_1_pool))
     else:
+        # two-class probabilities of the negatives from the last `update_probs`
+        preprob1 = train_table.preprob[label_0_pool]
+        preprob0 = 1 - preprob1
         while True:
-            label_0_hard, label_0_easy = [], []
-            for x in features_by_label[0]:
-                if x.preprob0 <= threshold:
-                    label_0_hard.append(x)
-                else:
-                    label_0_easy.append(x)
-            logits = torch.tensor([[x.preprob0, x.preprob1] for x in label_0_hard], dtype=torch.float).to(device)
-            labels = torch.tensor([0] * len(label_0_hard), dtype=torch.long).to(device)
-            # score = np.sum(-np.log(np.array([x.preprob0 for x in label_0_hard])))
+            hard_mask = (preprob0 <= threshold).numpy()
+            label_0_hard, label_0_easy = label_0_pool[hard_mask], label_0_pool[~hard_mask]
+            logits = torch.stack((preprob0[hard_mask], preprob1[hard_mask]), dim=1).to(device)
+            labels = torch.zeros(len(label_0_hard), dtype=torch.long).to(device)
+            # score = np.sum(-np.log(preprob0[hard_mask].numpy()))
             score = CrossEntropyLoss(reduction='sum')(logits, labels).item()
             if (score > pre_loss or abs(score - pre_loss) < pre_loss * 0.1) and len(label_0_hard) > args.positive_size:
                 break
@@ -1399,25 +1631,240 @@ def get_gated_sampling_dataloader(device, ep, args, features_by_label, pre_loss=
                     break
 
         logger.info(" gated-sampling result: th: %.2f, neg: %d, pos: %d" %
-                    (threshold, len(label_0_hard), len(features_by_label[1])))
+                    (threshold, len(label_0_hard), len(label_1_pool)))
         n_easy_sample = math.ceil(len(label_0_hard) * 0.1)
         if len(label_0_easy) > n_easy_sample:
             label_0_easy = np.random.choice(label_0_easy, math.ceil(len(label_0_hard) * 0.1))
             logger.info(" add noisy (easy) samples 10 percents of %d = %d" %
                         (len(label_0_hard), int(math.ceil(len(label_0_hard) * 0.1))))
-            total = np.concatenate((label_0_hard, label_0_easy, features_by_label[1]))
+            total = np.concatenate((label_0_hard, label_0_easy, label_1_pool))
             logger.info(" total sampling size (%d + %d + %d ) = %d" %
-                        (len(label_0_hard), len(label_0_easy), len(features_by_label[1]), len(total)))
+                        (len(label_0_hard), len(label_0_easy), len(label_1_pool), len(total)))
         else:
             logger.info(" No EASY samples!")
-            total = np.concatenate((label_0_hard, features_by_label[1]))
+            total = np.concatenate((label_0_hard, label_1_pool))
             logger.info(" total sampling size (%d + %d) = %d" %
-                        (len(label_0_hard), len(features_by_label[1]), len(total)))
+                        (len(label_0_hard), len(label_1_pool), len(total)))
+
+    return get_train_dataloader(args, train_table.subset(total))
+
 
-    train_data, _ = get_tensor_dataset(args, total, "classification")
-    train_sampler = RandomSampler(train_data)
-    train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
-    return train_dataloader
+def autocast(args, device):
+    """bfloat16 autocast on `device` under --precision bf16, a no-op context under fp32."""
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16,
+                          enabled=args.precision == 'bf16')
+
+
+def batch_logits(args, model, batch, processor):
+    """(logits, label_ids) of a batch on the device."""
+    if args.BERT:
+        input_ids, input_mask, segment_ids, label_ids, preprob = batch
+        outputs = model(input_ids, segment_ids, input_mask, labels=None)
+        return outputs[0], label_ids  # if labels is None, outputs[0] is logits
+    if args.task_name in ["cifar-10", "mnist", "svhn"]:
+        inputs, label_ids = batch
+        return model(normalize_images(inputs, processor.mean, processor.std)), label_ids
+    input_ids_a, input_ids_b, label_ids, preprob = batch
+    return model(input_ids_a, input_ids_b), label_ids
+
+
+def predict(args, model, dataset, device, processor, num_labels, output_mode):
+    """One inference pass over `dataset`; returns `(logits, probs, loss)` on the host, in dataset order.
+
+    Batches of --eval_batch_size run under `torch.inference_mode` and their
+    logits are written into a preallocated `(n, num_labels)` tensor on the
+    device, which is copied to the host once at the end. `loss` is the mean
+    of the batch losses.
+    """
+    loader, order = get_eval_dataloader(args, dataset, args.eval_batch_size)
+    if order is not None:
+        order = torch.as_tensor(order, device=device)
+    all_logits = torch.empty(len(dataset), num_labels, device=device)
+    loss_sum = torch.zeros((), device=device)
+    loss_fct = CrossEntropyLoss() if output_mode == "classification" else MSELoss()
+    model.eval()
+    start = 0
+    with torch.inference_mode(), autocast(args, device):
+        for batch in prefetch_to_device(loader, device):
+            logits, label_ids = batch_logits(args, model, batch, processor)
+            logits = logits.float()
+            if output_mode == "classification":
+                loss_sum += loss_fct(logits.view(-1, num_labels), label_ids.view(-1))
+            else:
+                loss_sum += loss_fct(logits.view(-1), label_ids.view(-1))
+            end = start + logits.size(0)
+            rows = slice(start, end) if order is None else order[start:end]
+            all_logits[rows] = logits.view(-1, num_labels)
+            start = end
+    logits = all_logits.cpu()
+    return logits, Softmax(dim=1)(logits), loss_sum.item() / max(len(loader), 1)
+
+
+def auto_micro_batch_size(args, model, train_data, processor, num_labels, device, effective_batch_size):
+    """Largest micro-batch size dividing `effective_batch_size` that fits --memory_budget_mb.
+
+    Every candidate runs one training forward/backward pass on the first
+    examples of `train_data`, padded to full length. The probes leave the model
+    (gradients, buffers such as batch norm statistics) and the RNG as they were.
+    """
+    device = torch.device(device)
+    buffers = [b.detach().clone() for b in model.buffers()]
+
+    def step_fn(batch_size):
+        loader = make_dataloader(args, train_data, num_workers=0, batch_size=batch_size)
+        batch = to_device(next(iter(loader)), device)
+        with autocast(args, device):
+            logits, label_ids = batch_logits(args, model, batch, processor)
+            loss = CrossEntropyLoss()(logits.view(-1, num_labels), label_ids.view(-1))
+        loss.backward()
+        model.zero_grad()
+
+    model.train()
+    with torch.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+        size, used = probe_micro_batch_size(step_fn, effective_batch_size, args.memory_budget_mb * 2 ** 20,
+                                            device, params=model.parameters())
+    with torch.no_grad():
+        for b, saved in zip(model.buffers(), buffers):
+            b.copy_(saved)
+    logger.info(" auto micro-batch: %d (%.1f MB of %.1f MB), %d accumulation steps" % (
+        size, used / 2 ** 20, args.memory_budget_mb, effective_batch_size // size))
+    return size
+
+
+def get_train_dataloader(args, train_data):
+    """Shuffling train loader; length-bucketed with trimmed padding under --dynamic_padding (BERT).
+
+    In distributed runs every rank buckets its own `DistributedSampler` share.
+    """
+    train_sampler = DistributedSampler(train_data) if args.local_rank != -1 else None
+    if args.dynamic_padding and args.BERT:
+        batch_sampler = BucketBatchSampler(dataset_lengths(train_data), args.train_batch_size,
+                                           shuffle=True, bucket_size=args.bucket_size, sampler=train_sampler)
+        return make_dataloader(args, train_data, batch_sampler=batch_sampler, collate_fn=trim_bert_batch)
+    if train_sampler is None:
+        train_sampler = RandomSampler(train_data)
+    return make_dataloader(args, train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+
+
+def get_eval_dataloader(args, eval_data, batch_size):
+    """Returns `(loader, order)`; outputs in loader order go back to dataset order with `restore_order`.
+
+    Under --dynamic_padding (BERT) the loader runs over length-sorted batches with
+    trimmed padding and `order` is the sorted index order, otherwise `order` is None.
+    """
+    if args.dynamic_padding and args.BERT:
+        batch_sampler = BucketBatchSampler(dataset_lengths(eval_data), batch_size, shuffle=False)
+        return (make_dataloader(args, eval_data, batch_sampler=batch_sampler, collate_fn=trim_bert_batch),
+                batch_sampler.order)
+    return make_dataloader(args, eval_data, sampler=SequentialSampler(eval_data), batch_size=batch_size), None
+
+
+def get_streaming_dataloader(args, processor, split, label_list, tokenizer, output_mode):
+    """Loader over a `StreamingDataset` of `split`; converts examples in `--preprocess_workers` workers."""
+    if not args.BERT:
+        raise ValueError("--streaming is only supported for BERT models")
+    label_map = {label: i for i, label in enumerate(label_list)}
+    convert_fn = functools.partial(_example_to_tensors, label_map, args.max_seq_length, tokenizer, output_mode)
+    if args.local_rank == -1:
+        rank, world_size = 0, 1
+    else:
+        rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+    # no length bucketing without random access, but batches can still be trimmed
+    collate_fn = trim_bert_batch if args.dynamic_padding else default_collate
+    dataset = StreamingDataset(processor, args.data_dir, split, convert_fn,
+                               num_examples=count_examples(processor, args.data_dir, split),
+                               batch_size=args.train_batch_size, collate_fn=collate_fn,
+                               shuffle_buffer_size=args.shuffle_buffer, seed=args.seed,
+                               rank=rank, world_size=world_size)
+    logger.info(" streaming %s: %d examples, shuffle buffer %d" % (split, dataset.num_examples, args.shuffle_buffer))
+    num_workers = args.preprocess_workers if args.preprocess_workers > 1 else args.num_workers
+    # the dataset yields whole batches; workers must be restarted every epoch to see its new `set_epoch`
+    return make_dataloader(args, dataset, num_workers=num_workers, persistent_workers=False, batch_size=None)
+
+
+def make_dataloader(args, dataset, num_workers=None, persistent_workers=None, **kwargs):
+    """DataLoader set up by --num_workers, --pin_memory, --persistent_workers and --prefetch_factor.
+
+    Batches are moved to the device by `prefetch_to_device`, which copies
+    asynchronously from pinned memory.
+    """
+    num_workers = args.num_workers if num_workers is None else num_workers
+    if num_workers > 0:
+        kwargs["persistent_workers"] = args.persistent_workers if persistent_workers is None else persistent_workers
+        kwargs["prefetch_factor"] = args.prefetch_factor
+    pin_memory = args.pin_memory and torch.cuda.is_available() and not args.no_cuda
+    return DataLoader(dataset, num_workers=num_workers, pin_memory=pin_memory, **kwargs)
+
+
+def convert_examples(args, examples, label_list, tokenizer, output_mode, word2idx_dict=None):
+    """Converts text examples with the BERT or the RNN feature converter."""
+    if args.BERT:
+        return convert_examples_to_features(
+            examples, label_list, args.max_seq_length, tokenizer, output_mode,
+            num_workers=args.preprocess_workers)
+    return convert_examples_to_features_rnn(
+        word2idx_dict, examples, label_list, args.max_seq_length, tokenizer, output_mode,
+        num_workers=args.preprocess_workers)
+
+
+def get_vocab_size(args, tokenizer, word2idx_dict=None):
+    if args.BERT:
+        return len(tokenizer.vocab)
+    return len(word2idx_dict)
+
+
+def feature_cache_parts(args, processor, split, label_list, tokenizer, output_mode, word2idx_dict=None):
+    """Everything the converted `split` depends on; hashed into its feature cache key."""
+    parts = {
+        "task": args.task_name.lower(),
+        "split": split,
+        "processor": type(processor).__name__,
+    }
+    if args.task_name in ["cifar-10", "mnist", "svhn"]:
+        parts["image_format"] = "uint8-nchw"
+        parts["recipe"] = processor.recipe()
+        return parts
+    parts.update({
+        "model": "bert" if args.BERT else args.model_name,
+        "max_seq_length": args.max_seq_length,
+        "do_lower_case": args.do_lower_case,
+        "output_mode": output_mode,
+        "label_list": [str(label) for label in label_list],
+        "vocab": vocab_fingerprint(tokenizer.vocab if args.BERT else word2idx_dict),
+        "data_dir": os.path.abspath(args.data_dir),
+        "data_files": [file_fingerprint(path, content_hash=args.cache_content_hash)
+                       for path in processor.get_data_files(args.data_dir, split)],
+    })
+    return parts
+
+
+def load_dataset(args, store, processor, split, label_list, tokenizer, output_mode, word2idx_dict=None,
+                 examples=None):
+    """Returns `(dataset, label_ids)` of `split`, converting it only when `store` has no valid entry."""
+    parts = feature_cache_parts(args, processor, split, label_list, tokenizer, output_mode, word2idx_dict)
+    desc = "%s %s" % (args.task_name, split)
+
+    if args.task_name in ["cifar-10", "mnist", "svhn"]:
+        def write_images(path):
+            # raw uint8 images; batches are normalized with `normalize_images` on the device
+            images, labels = getattr(processor, "get_%s_examples" % split)(args.data_dir)
+            torch.save({"inputs": torch.from_numpy(images),
+                        "label_ids": torch.from_numpy(labels)}, os.path.join(path, "tensors.pt"))
+
+        tensors = store.load_or_build(parts, write_images, lambda path: torch.load(os.path.join(path, "tensors.pt")),
+                                      desc=desc)
+        return TensorDataset(tensors["inputs"], tensors["label_ids"]), tensors["label_ids"]
+
+    def write_features(path):
+        _examples = examples
+        if _examples is None:
+            _examples = getattr(processor, "get_%s_examples" % split)(args.data_dir)
+        features = convert_examples(args, _examples, label_list, tokenizer, output_mode, word2idx_dict)
+        save_features(path, features, args.max_seq_length, get_vocab_size(args, tokenizer, word2idx_dict),
+                      output_mode)
+
+    dataset = store.load_or_build(parts, write_features, MemmapFeatureDataset, desc=desc)
+    return dataset, dataset.label_ids
 
 
 def get_tensor_dataset(args, features, output_mode):
@@ -1444,14 +1891,5 @@ def get_tensor_dataset(args, features, output_mode):
     return train_data, all_label_ids
 
 
-def KL_loss(p, q):
-    var1 = p.var()
-    mu1 = p.mean()
-    var2 = q.var()
-    mu2 = q.mean()
-    # return 0.5 * (torch.log(var2 / var1) + (var1 / var2) - 1)
-    return 0.5 * (torch.log(var2 / var1) + ((var1 + (mu1 - mu2) * (mu1 - mu2)) / var2) - 1)
-
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,71 @@
+"""SemEval 2016/2017 Task 3 (subtask A) scores, computed in memory.
+
+`semeval_scores` gives the numbers of the official scorer,
+`python2.7 semeval/ev.py <relevancy file> <pred file>`, from the scores of
+the pairs: no prediction file to re-read and no Python 2 process. Every
+question's candidates are ranked by descending score into one padded
+[n_questions, max_candidates] array, so the metrics of `semeval/metrics.py`
+are a few array reductions instead of loops over dicts.
+"""
+
+import numpy as np
+
+
+def ranked_relevance(question_ids, scores, relevant, th=0):
+    """Relevance of every question's candidates by descending score, padded with False.
+
+    Ties keep the input order, like the stable sort of ev.py. The array has at
+    least `th` columns.
+    """
+    scores = np.asarray(scores)
+    relevant = np.asarray(relevant, dtype=bool)
+    _, group = np.unique(np.asarray(question_ids), return_inverse=True)
+    order = np.lexsort((-scores, group))
+    group = group[order]
+    lengths = np.bincount(group)
+    position = np.arange(len(group)) - (np.cumsum(lengths) - lengths)[group]
+    ranked = np.zeros((len(lengths), max(lengths.max(), th)), dtype=bool)
+    ranked[group, position] = relevant[order]
+    return ranked
+
+
+def semeval_scores(question_ids, scores, relevant, predicted, th=10, ignore_noanswer=False):
+    """Scores of the pairs, as computed by ev.py at threshold `th`.
+
+    `question_ids`, `scores`, `relevant` (gold) and `predicted` (the
+    true/false label of the prediction file) have one entry per pair. Returns a
+    dict with the classification `acc` and `f1`, and the ranking `MAP`, `MRR`
+    (in percent), `AvgRec` and `REC-1` (percentage of questions with a
+    relevant candidate in the top 1..th).
+    """
+    relevant = np.asarray(relevant, dtype=bool)
+    predicted = np.asarray(predicted, dtype=bool)
+    tp = np.sum(relevant & predicted)
+    p = tp / predicted.sum() if predicted.any() else 0
+    r = tp / relevant.sum() if relevant.any() else 0
+    result = {"acc": np.mean(relevant == predicted),
+              "f1": 2.0 * p * r / (p + r) if p + r > 0 else 0}
+
+    ranked = ranked_relevance(question_ids, scores, relevant, th)
+    if ignore_noanswer:
+        ranked = ranked[ranked.any(axis=1)]
+    num_questions = len(ranked)
+    top = ranked[:, :th]
+    ranks = np.arange(1, th + 1)
+
+    # average precision over the relevant candidates within the threshold
+    num_correct = np.cumsum(top, axis=1)
+    precision_sum = np.sum(np.where(top, num_correct / ranks, 0.0), axis=1)
+    found = num_correct[:, -1]
+    result["MAP"] = np.sum(precision_sum[found > 0] / found[found > 0]) / num_questions
+
+    first = top.argmax(axis=1)
+    answered = top.any(axis=1)
+    result["MRR"] = np.sum(1.0 / (first[answered] + 1)) * 100.0 / num_questions
+    result["REC-1"] = np.cumsum(np.bincount(first[answered], minlength=th)) * 100.0 / num_questions
+
+    # correct answers at @X normalized by those of a perfect re-ranker
+    correct = np.cumsum(top.sum(axis=0))
+    max_correct = np.minimum(ranks, ranked.sum(axis=1)[:, None]).sum(axis=0)
+    result["AvgRec"] = np.mean(correct / max_correct)
+    return result
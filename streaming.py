@@ -0,0 +1,121 @@
+"""Iterable training dataset that converts examples on the fly.
+
+`StreamingDataset` reads a split with `DataProcessor.iter_examples` and
+converts every example as it is consumed, so neither the examples nor the
+features of the whole split are ever held in memory. Like `DistributedSampler`,
+every distributed rank gets the same number of examples (the first ones are
+repeated to even the split out). Each rank's examples are cut into batches
+before they are split across DataLoader workers, so only the last batch of a
+rank is partial and the loader yields exactly `len()` batches. Examples are
+shuffled through a bounded buffer: memory stays constant, but the shuffle is
+only as wide as the buffer.
+"""
+
+import itertools
+import math
+import random
+
+from torch.utils.data import IterableDataset, TensorDataset, get_worker_info
+from torch.utils.data.dataloader import default_collate
+
+
+def shuffle_buffer(items, buffer_size, rng):
+    """Yields `items` in an order shuffled within a window of `buffer_size` items."""
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    for item in buffer:
+        yield item
+
+
+class StreamingDataset(IterableDataset):
+    """Yields batches of `convert_fn(index, example)` for the examples of `processor.iter_examples(data_dir, set_type)`.
+
+    `num_examples` is the size of the split. Batches of `batch_size` items are
+    collated by `collate_fn`, so the DataLoader must be built with
+    `batch_size=None`. `rank` / `world_size` shard the split across
+    distributed processes on top of the DataLoader workers. Call `set_epoch`
+    before every epoch to draw a different shuffle.
+    """
+
+    def __init__(self, processor, data_dir, set_type, convert_fn, num_examples, batch_size,
+                 collate_fn=default_collate, shuffle_buffer_size=10000, seed=42, rank=0, world_size=1):
+        self.processor = processor
+        self.data_dir = data_dir
+        self.set_type = set_type
+        self.convert_fn = convert_fn
+        self.num_examples = num_examples
+        self.batch_size = batch_size
+        self.collate_fn = collate_fn
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @property
+    def examples_per_rank(self):
+        return int(math.ceil(self.num_examples / self.world_size))
+
+    def __len__(self):
+        # batches of this rank, over all of its DataLoader workers
+        return int(math.ceil(self.examples_per_rank / self.batch_size))
+
+    def head(self, num_examples):
+        """`TensorDataset` of the first `num_examples` converted examples of the split (e.g. for a memory probe)."""
+        examples = itertools.islice(self.processor.iter_examples(self.data_dir, self.set_type), num_examples)
+        items = [self.convert_fn(index, example) for index, example in enumerate(examples)]
+        return TensorDataset(*default_collate(items))
+
+    def _selected(self, worker_id, num_workers):
+        """Yields the `(index, example)` of this rank and worker.
+
+        The j-th example of the rank is the example `(rank + j * world_size) % num_examples`
+        and belongs to the worker of its batch, `(j // batch_size) % num_workers`.
+        """
+        def owned(j):
+            return (j // self.batch_size) % num_workers == worker_id
+
+        # positions past the end of the split wrap around to its first examples
+        padding = [(self.rank + j * self.world_size) % self.num_examples
+                   for j in range(self.examples_per_rank)
+                   if self.rank + j * self.world_size >= self.num_examples and owned(j)]
+        repeated = {}
+        for index, example in enumerate(self.processor.iter_examples(self.data_dir, self.set_type)):
+            if index in padding:
+                repeated[index] = example
+            if index % self.world_size == self.rank and owned(index // self.world_size):
+                yield index, example
+        for index in padding:
+            yield index, repeated[index]
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        examples = self._selected(worker_id, num_workers)
+        if self.shuffle_buffer_size > 1:
+            shard = self.rank * num_workers + worker_id
+            rng = random.Random(self.seed + self.epoch * self.world_size * num_workers + shard)
+            examples = shuffle_buffer(examples, self.shuffle_buffer_size, rng)
+        batch = []
+        for index, example in examples:
+            batch.append(self.convert_fn(index, example))
+            if len(batch) == self.batch_size:
+                yield self.collate_fn(batch)
+                batch = []
+        if batch:
+            yield self.collate_fn(batch)
+
+
+def count_examples(processor, data_dir, set_type):
+    """Number of examples of a split, counted by streaming it (nothing is tokenized)."""
+    return sum(1 for _ in processor.iter_examples(data_dir, set_type))
@@ -0,0 +1,66 @@
+import os
+import random
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from feature_assembly import assemble_bert_inputs, truncate_pair_lengths  # noqa: E402
+
+CLS, SEP = 101, 102
+
+
+def convert_one(ids_a, ids_b, is_pair, max_seq_length):
+    """Per-example BERT input layout, as `convert_examples_to_features` built it one example at a time."""
+    tokens_a, tokens_b = list(ids_a), None
+    if is_pair:
+        tokens_b = list(ids_b)
+        # pop from the longer sequence until [CLS] A [SEP] B [SEP] fits
+        while len(tokens_a) + len(tokens_b) > max_seq_length - 3:
+            if len(tokens_a) > len(tokens_b):
+                tokens_a.pop()
+            else:
+                tokens_b.pop()
+    else:
+        tokens_a = tokens_a[:max_seq_length - 2]
+    input_ids = [CLS] + tokens_a + [SEP]
+    segment_ids = [0] * len(input_ids)
+    if tokens_b:
+        input_ids += tokens_b + [SEP]
+        segment_ids += [1] * (len(tokens_b) + 1)
+    input_mask = [1] * len(input_ids)
+    padding = [0] * (max_seq_length - len(input_ids))
+    return input_ids + padding, input_mask + padding, segment_ids + padding
+
+
+def test_truncate_pair_lengths_matches_popping():
+    for max_length in range(0, 12):
+        for len_a in range(0, 15):
+            for len_b in range(0, 15):
+                a, b = list(range(len_a)), list(range(len_b))
+                while len(a) + len(b) > max_length:
+                    if len(a) > len(b):
+                        a.pop()
+                    else:
+                        b.pop()
+                assert tuple(truncate_pair_lengths(np.array([len_a]), np.array([len_b]), max_length)) == (
+                    len(a), len(b))
+
+
+def test_assemble_bert_inputs_matches_per_example_conversion():
+    rng = random.Random(0)
+    for max_seq_length in [5, 8, 16, 33]:
+        ids_a, ids_b, is_pair = [], [], []
+        for _ in range(200):
+            pair = rng.random() < 0.7
+            ids_a.append([rng.randrange(1000, 2000) for _ in range(rng.randrange(0, 40))])
+            # a text_b may still tokenize to nothing
+            ids_b.append([rng.randrange(1000, 2000) for _ in range(rng.randrange(0, 40))] if pair else [])
+            is_pair.append(pair)
+        input_ids, input_mask, segment_ids = assemble_bert_inputs(ids_a, ids_b, is_pair, max_seq_length, CLS, SEP)
+        for i in range(len(ids_a)):
+            expected = convert_one(ids_a[i], ids_b[i], is_pair[i], max_seq_length)
+            assert input_ids[i].tolist() == expected[0]
+            assert input_mask[i].tolist() == expected[1]
+            assert segment_ids[i].tolist() == expected[2]
@@ -0,0 +1,82 @@
+import collections
+import os
+import sys
+
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from micro_batch import probe_micro_batch_size, step_memory  # noqa: E402
+from streaming import StreamingDataset  # noqa: E402
+
+
+class RangeProcessor(object):
+    """Stands in for a `DataProcessor`: the examples of a split are 0 .. num_examples - 1."""
+
+    def __init__(self, num_examples):
+        self.num_examples = num_examples
+
+    def iter_examples(self, data_dir, set_type):
+        return iter(range(self.num_examples))
+
+
+def to_tensor(index, example):
+    return torch.tensor([example])
+
+
+def make_loader(num_examples, batch_size, num_workers, rank=0, world_size=1):
+    dataset = StreamingDataset(RangeProcessor(num_examples), None, "train", to_tensor, num_examples,
+                               batch_size=batch_size, shuffle_buffer_size=4, rank=rank, world_size=world_size)
+    return DataLoader(dataset, batch_size=None, num_workers=num_workers)
+
+
+def test_len_matches_batches_with_workers():
+    for num_examples, batch_size in [(10, 4), (12, 4), (13, 3), (3, 4)]:
+        loader = make_loader(num_examples, batch_size, num_workers=2)
+        batches = list(loader)
+        assert len(loader) == sum(1 for _ in loader) == len(batches)
+        assert sorted(torch.cat(batches).flatten().tolist()) == list(range(num_examples))
+        # only the last batch of the rank is partial
+        assert sum(len(b) < batch_size for b in batches) <= 1
+
+
+def test_ranks_get_equal_shares():
+    num_examples, world_size = 10, 4
+    seen = collections.Counter()
+    lengths = set()
+    for rank in range(world_size):
+        loader = make_loader(num_examples, 2, num_workers=2, rank=rank, world_size=world_size)
+        batches = list(loader)
+        assert len(loader) == len(batches)
+        lengths.add(sum(len(b) for b in batches))
+        seen.update(torch.cat(batches).flatten().tolist())
+    # 10 examples over 4 ranks: 3 each, the first 2 examples are repeated
+    assert lengths == {3}
+    assert set(seen) == set(range(num_examples))
+    assert sum(seen.values()) == 12
+    assert seen[0] == seen[1] == 2
+
+
+def to_pair(index, example):
+    return torch.full((6,), float(example)), torch.tensor(example % 2)
+
+
+def test_micro_batch_probe_on_streaming_examples():
+    dataset = StreamingDataset(RangeProcessor(20), None, "train", to_pair, 20, batch_size=4)
+    probe_data = dataset.head(8)
+    assert len(probe_data) == 8
+    model = torch.nn.Sequential(torch.nn.Linear(6, 16), torch.nn.ReLU(), torch.nn.Linear(16, 2))
+    shapes = []
+
+    def step_fn(batch_size):
+        inputs, labels = next(iter(DataLoader(probe_data, batch_size=batch_size)))
+        shapes.append(tuple(inputs.shape))
+        torch.nn.functional.cross_entropy(model(inputs), labels).backward()
+        model.zero_grad()
+
+    # a budget of exactly the activations of 4 examples: 8 do not fit
+    used_by_four = step_memory(lambda: step_fn(4), "cpu", list(model.parameters()))
+    size, used = probe_micro_batch_size(step_fn, 8, used_by_four, "cpu", params=model.parameters())
+    assert (size, used) == (4, used_by_four)
+    assert all(len(shape) == 2 and shape[1] == 6 for shape in shapes)
@@ -0,0 +1,89 @@
+"""Memoized tokenization.
+
+In the answer selection tasks (WikiQA, SemEval, SelQA, Ubuntu, DSTC) every
+question / context comes with 10-100 candidates, so the same `text_a` is
+tokenized over and over. `CachedTokenizer` wraps a tokenizer (the BERT
+tokenizer or `simple_tokenizer`) with a bounded LRU cache keyed on the raw
+string; everything except `tokenize` is delegated to the wrapped tokenizer.
+"""
+
+from collections import OrderedDict
+
+
+class CachedTokenizer(object):
+    """LRU cache of at most `max_size` `tokenize` results in front of `tokenizer`."""
+
+    def __init__(self, tokenizer, max_size=100000):
+        self.tokenizer = tokenizer
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def tokenize(self, text):
+        tokens = self._cache.get(text)
+        if tokens is None:
+            self.misses += 1
+            tokens = tuple(self.tokenizer.tokenize(text))
+            self._store(text, tokens)
+        else:
+            self.hits += 1
+            self._cache.move_to_end(text)
+        # callers may change the token lists in place, so never hand out the cached value
+        return list(tokens)
+
+    def tokenize_batch(self, texts, **kwargs):
+        """Batched `tokenize`: every distinct uncached text is tokenized once, in one batch if possible."""
+        missing = list(OrderedDict.fromkeys(text for text in texts if text not in self._cache))
+        if hasattr(self.tokenizer, "tokenize_batch"):
+            new_tokens = self.tokenizer.tokenize_batch(missing, **kwargs)
+        else:
+            new_tokens = [self.tokenizer.tokenize(text) for text in missing]
+        # texts of this batch are looked up below, so keep them even beyond `max_size`
+        batch = {text: tuple(tokens) for text, tokens in zip(missing, new_tokens)}
+        out = []
+        for text in texts:
+            tokens = batch.get(text)
+            if tokens is None:
+                out.append(self.tokenize(text))
+                continue
+            self.misses += 1
+            del batch[text]
+            self._store(text, tokens)
+            out.append(list(tokens))
+        return out
+
+    def _store(self, text, tokens):
+        self._cache[text] = tokens
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def stats(self):
+        return "tokenization cache: %d lookups, hit rate %.4f, %d / %d entries" % (
+            self.hits + self.misses, self.hit_rate(), len(self._cache), self.max_size)
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the wrapper itself
+        if name == "tokenizer":
+            raise AttributeError(name)
+        return getattr(self.tokenizer, name)
+
+    def __getstate__(self):
+        # worker processes start with an empty cache instead of a pickled copy of ours
+        state = self.__dict__.copy()
+        state["_cache"] = OrderedDict()
+        state["hits"] = state["misses"] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+def log_tokenization_stats(tokenizer, logger):
+    """Logs the cache statistics of `tokenizer` if it is a `CachedTokenizer` that was used."""
+    if isinstance(tokenizer, CachedTokenizer) and tokenizer.hits + tokenizer.misses > 0:
+        logger.info(tokenizer.stats())
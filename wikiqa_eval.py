@@ -1,41 +1,24 @@
-import torch
 import numpy as np
 
+from pair_inference import pair_logits, softmax_rows
+
 
 def accuracy(out, labels):
     outputs = np.argmax(out, axis=1)
     return np.sum(outputs == labels)
 
 
-def softmax(x):
-    return np.exp(x) / np.sum(np.exp(x), axis=0)
-
-
-def wikiqa_eval(ep, device, eval_examples, eval_dataloader, model, logger, BERT):
+def wikiqa_eval(ep, device, eval_examples, eval_dataloader, model, logger, BERT, order=None):
+    """`eval_dataloader` may batch the pairs in any order; `order[i]` is the example index of its i-th pair."""
     logger.info("***** [epoch %d] Running evaluation with official code *****" % ep)
     logger.info("  Num examples = %d", len(eval_examples))
-    model.eval()
-    eval_accuracy, nb_eval_example = 0, 0
-    data = []
-    for i, batch in enumerate(eval_dataloader):
-        batch = tuple(t.to(device) for t in batch)
-        with torch.no_grad():
-            if BERT:
-                input_ids, input_mask, segment_ids, label_ids, preprob = batch
-                output = model(input_ids, segment_ids, input_mask, labels=None)
-            else:
-                input_ids_a, input_ids_b, label_ids, preprob = batch
-                output = model(input_ids_a, input_ids_b)
-            logits = output[0]
-
-        logits = logits.detach().cpu().numpy()
-        label_ids = label_ids.to('cpu').numpy()
+    logits, label_ids = pair_logits(device, eval_dataloader, model, BERT, order)
 
-        eval_accuracy += accuracy(logits, label_ids)
-        nb_eval_example += len(label_ids)
+    eval_accuracy = accuracy(logits, label_ids)
+    nb_eval_example = len(label_ids)
 
-        logits2 = softmax(logits[0])
-        data.append([eval_examples[i].guid, "-", "-", label_ids[0], logits2[1]])
+    probs = softmax_rows(logits)
+    data = [[example.guid, "-", "-", label_ids[i], probs[i, 1]] for i, example in enumerate(eval_examples)]
 
     eval_accuracy = eval_accuracy / nb_eval_example
     results = get_prf(data, thre=0.11)